@@ -5,30 +5,68 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import os
 import re
+import array
+import errno
 import sys
+import glob
+import json
+import zlib
+import struct
+import time
 import argparse
+import atexit
+import bisect
+import importlib
+import threading
+from collections import OrderedDict, namedtuple
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 
 try:
     import xml.etree.cElementTree as ET
 except ImportError:
     import xml.etree.ElementTree as ET
 
-import upcean.barcodes.shortcuts
-
 PY2 = (sys.version_info[0] == 2)
 
 if PY2:
-    import urllib2
     try:
         from cStringIO import StringIO as _Py2BytesIO
     except ImportError:
         from StringIO import StringIO as _Py2BytesIO
 else:
-    import urllib.request as urllib2
     from io import BytesIO as _Py3BytesIO
 
+
+class _LazyModule(object):
+    """
+    Stand-in for a module that is imported on first attribute access. Barcode,
+    network, server and profiling support is only loaded by documents and
+    commands that use it, which keeps CLI startup for plain shapes short.
+    """
+    __slots__ = ("_name", "_module")
+
+    def __init__(self, name, py2_name=None):
+        self._name = py2_name if PY2 and py2_name else name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+upcean_shortcuts = _LazyModule("upcean.barcodes.shortcuts")
+urllib2 = _LazyModule("urllib.request", "urllib2")
+httplib = _LazyModule("http.client", "httplib")
+urlparse = _LazyModule("urllib.parse", "urlparse")
+queue = _LazyModule("queue", "Queue")
+socket = _LazyModule("socket")
+hashlib = _LazyModule("hashlib")
+difflib = _LazyModule("difflib")
+tracemalloc = _LazyModule("tracemalloc")
+multiprocessing = _LazyModule("multiprocessing")
+
 def _bytes_io(data):
     return _Py2BytesIO(data) if PY2 else _Py3BytesIO(data)
 
@@ -40,13 +78,18 @@ _RGB_RE = re.compile(
     r"(\d|[1-9]\d|1\d\d|2[0-4]\d|25[0-5])\s*\)\s*$"
 )
 _PCT_RE = re.compile(r"^(\d+)\%$")
+_PACKED_SPLIT_RE = re.compile(r"[\s,]+")
 
 # Pillow resampling
 _RESAMPLE = {
     "nearest": Image.NEAREST,
     "bilinear": Image.BILINEAR,
     "bicubic": Image.BICUBIC,
-    "antialias": getattr(Image, "LANCZOS", Image.ANTIALIAS),
+    "antialias": getattr(Image, "LANCZOS", None) or getattr(Image, "ANTIALIAS"),
+    # "vector" scales the drawing itself (see scale_plan); pictures are resampled from source.
+    "vector": Image.BICUBIC,
+    "box": getattr(Image, "BOX", Image.NEAREST),
+    "lanczos": getattr(Image, "LANCZOS", None) or getattr(Image, "ANTIALIAS"),
 }
 
 __project__ = "PyXML-Draw"
@@ -62,6 +105,297 @@ def safe_int(val, default=0):
         return default
 
 
+class LRUCache(object):
+    """
+    Thread-safe LRU mapping bounded by entry count and/or total byte size.
+    `sizeof(value)` gives an entry's size when `maxbytes` is set.
+    """
+
+    def __init__(self, maxitems=None, maxbytes=None, sizeof=None):
+        self.maxitems = maxitems
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._data.pop(key)[1]
+            if self.maxbytes is not None and size > self.maxbytes:
+                return value
+            self._data[key] = (value, size)
+            self._bytes += size
+            while self._data and (
+                    (self.maxitems is not None and len(self._data) > self.maxitems) or
+                    (self.maxbytes is not None and self._bytes > self.maxbytes)):
+                self._bytes -= self._data.popitem(last=False)[1][1]
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "items": len(self._data),
+            "bytes": self._bytes,
+            "maxitems": self.maxitems,
+            "maxbytes": self.maxbytes,
+        }
+
+
+# Opt-in instrumentation. Every hook checks PROFILER first, so a disabled
+# profiler costs one global lookup per element.
+PROFILER = None
+
+
+class _Measure(object):
+    __slots__ = ("profile", "phase", "tag")
+
+    def __init__(self, profile, phase, tag):
+        self.profile = profile
+        self.phase = phase
+        self.tag = tag
+
+    def __enter__(self):
+        self.profile._enter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile._exit(self.phase, self.tag)
+        return False
+
+
+class RenderProfile(object):
+    """
+    Wall time and Python allocations per (phase, tag), e.g. ("draw",
+    "polygon") or ("fetch", host). Times are exclusive: a font loaded while
+    resolving a <text> counts under "font", not "resolve". Allocations are the
+    net bytes tracemalloc saw (Pillow's pixel buffers are not traced).
+    """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.records = {}
+        self.started = time.time()
+        self.stopped = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def measure(self, phase, tag=None):
+        return _Measure(self, phase, tag)
+
+    def _now_bytes(self):
+        return tracemalloc.get_traced_memory()[0] if self.trace_memory and tracemalloc.is_tracing() else 0
+
+    def _enter(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        # [start time, start bytes, child seconds, child bytes]
+        stack.append([time.time(), self._now_bytes(), 0.0, 0])
+
+    def _exit(self, phase, tag):
+        stack = self._local.stack
+        start, start_bytes, child_seconds, child_bytes = stack.pop()
+        seconds = time.time() - start
+        nbytes = self._now_bytes() - start_bytes
+        if stack:
+            stack[-1][2] += seconds
+            stack[-1][3] += nbytes
+        self.add(phase, tag, seconds - child_seconds, nbytes - child_bytes)
+
+    def add(self, phase, tag, seconds, nbytes=0):
+        key = (phase, tag or "")
+        with self._lock:
+            rec = self.records.get(key)
+            if rec is None:
+                rec = self.records[key] = [0, 0.0, 0]
+            rec[0] += 1
+            rec[1] += seconds
+            rec[2] += nbytes
+
+    def report(self):
+        """Machine-readable report: totals per phase and per (phase, tag), costliest first."""
+        wall = (self.stopped or time.time()) - self.started
+        entries = sorted(self.records.items(), key=lambda item: -item[1][1])
+        phases = {}
+        for (phase, tag), (count, seconds, nbytes) in entries:
+            total = phases.setdefault(phase, {"count": 0, "seconds": 0.0, "alloc_bytes": 0})
+            total["count"] += count
+            total["seconds"] += seconds
+            total["alloc_bytes"] += nbytes
+        return {
+            "wall_seconds": wall,
+            "measured_seconds": sum(rec[1] for rec in self.records.values()),
+            "phases": phases,
+            "entries": [{"phase": phase, "tag": tag, "count": count, "seconds": seconds, "alloc_bytes": nbytes}
+                        for (phase, tag), (count, seconds, nbytes) in entries],
+        }
+
+    def summary(self, limit=25):
+        """Human-readable table of the costliest (phase, tag) pairs."""
+        report = self.report()
+        wall = report["wall_seconds"] or 1e-9
+        lines = ["render profile: {:.1f} ms wall, {:.1f} ms measured".format(
+            report["wall_seconds"] * 1000, report["measured_seconds"] * 1000),
+            "{:<10} {:<24} {:>7} {:>10} {:>9} {:>10} {:>6}".format(
+                "phase", "tag", "count", "total ms", "mean ms", "alloc KB", "share")]
+        for entry in report["entries"][:limit]:
+            lines.append("{:<10} {:<24} {:>7} {:>10.2f} {:>9.3f} {:>10.1f} {:>5.1f}%".format(
+                entry["phase"], entry["tag"][:24], entry["count"], entry["seconds"] * 1000,
+                entry["seconds"] * 1000 / entry["count"], entry["alloc_bytes"] / 1024.0,
+                100.0 * entry["seconds"] / wall))
+        if len(report["entries"]) > limit:
+            lines.append("... {} more".format(len(report["entries"]) - limit))
+        return "\n".join(lines)
+
+
+def _profiled(phase, tag, func, *args, **kwargs):
+    """func(*args, **kwargs), measured under (phase, tag) while profiling."""
+    if PROFILER is None:
+        return func(*args, **kwargs)
+    with PROFILER.measure(phase, tag):
+        return func(*args, **kwargs)
+
+
+def enable_profiling(trace_memory=True):
+    """Start recording into a fresh RenderProfile (also tracing allocations unless told not to)."""
+    global PROFILER
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    PROFILER = RenderProfile(trace_memory)
+    return PROFILER
+
+
+def disable_profiling():
+    """Stop recording; returns the RenderProfile that was active, if any."""
+    global PROFILER
+    profile, PROFILER = PROFILER, None
+    if profile is not None:
+        profile.stopped = time.time()
+        if profile.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+    return profile
+
+
+# Fonts are keyed on (resolved path, size, index, layout engine).
+_FONT_CACHE = LRUCache(maxitems=128)
+_FONT_EXTS = (".ttf", ".otf", ".ttc")
+_FONT_INDEX = None
+_FONT_INDEX_LOCK = threading.Lock()
+
+
+def font_search_path():
+    """Directories searched for font names: $XIF_FONT_PATH first, then the usual system locations."""
+    dirs = [d for d in os.environ.get("XIF_FONT_PATH", "").split(os.pathsep) if d]
+    dirs.extend([
+        "/usr/share/fonts", "/usr/local/share/fonts",
+        os.path.expanduser("~/.fonts"), os.path.expanduser("~/.local/share/fonts"),
+        "/Library/Fonts", "/System/Library/Fonts", os.path.expanduser("~/Library/Fonts"),
+    ])
+    if os.environ.get("WINDIR"):
+        dirs.append(os.path.join(os.environ["WINDIR"], "Fonts"))
+    return dirs
+
+
+def _font_key(name):
+    """'DejaVu Sans' / 'dejavu-sans.ttf' -> 'dejavusans'"""
+    stem = os.path.basename(name)
+    if stem.lower().endswith(_FONT_EXTS):
+        stem = stem[:-4]
+    return re.sub(r"[\s_\-]+", "", stem).lower()
+
+
+def _font_index():
+    """Map normalized font names to paths; built once per process."""
+    global _FONT_INDEX
+    with _FONT_INDEX_LOCK:
+        if _FONT_INDEX is None:
+            index = {}
+            for top in font_search_path():
+                for dirpath, dirnames, filenames in os.walk(top):
+                    for fn in sorted(filenames):
+                        if fn.lower().endswith(_FONT_EXTS):
+                            index.setdefault(_font_key(fn), os.path.join(dirpath, fn))
+            _FONT_INDEX = index
+        return _FONT_INDEX
+
+
+def resolve_font_path(font_spec):
+    """Font file path or family-ish name ('Verdana') -> real path, or None."""
+    if not font_spec:
+        return None
+    if os.path.isfile(font_spec):
+        return os.path.abspath(font_spec)
+    return _font_index().get(_font_key(font_spec))
+
+
+def get_font(font_spec, size, index=0, layout_engine=None):
+    """ImageFont.truetype() through the process-wide font cache."""
+    path = resolve_font_path(font_spec) or font_spec
+    key = (path, size, index, layout_engine)
+    font = _FONT_CACHE.get(key)
+    if font is None:
+        font = _FONT_CACHE.put(key, _profiled("font", os.path.basename(str(path)), ImageFont.truetype,
+                                              path, size, index=index, layout_engine=layout_engine))
+    return font
+
+
+def _image_nbytes(img):
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+# Converted RGBA barcode rasters, bounded by decoded size.
+_BARCODE_CACHE = LRUCache(maxbytes=64 * 1024 * 1024, sizeof=_image_nbytes)
+_BARCODE_KEYS = ("bctype", "upc", "resize", "hideinfo", "barheight", "textxy", "barcolor")
+
+
+def _draw_barcode(kw):
+    return upcean_shortcuts.validate_draw_barcode(**kw).convert("RGBA")
+
+
+def get_barcode_image(**kw):
+    """
+    upcean's validate_draw_barcode(**kw).convert("RGBA"), memoized on the
+    barcode parameters. The returned image is shared: paste it, don't modify it.
+    """
+    key = tuple(kw.get(k) for k in _BARCODE_KEYS)
+    bc = _BARCODE_CACHE.get(key)
+    if bc is None:
+        bc = _BARCODE_CACHE.put(key, _profiled("barcode", kw.get("bctype"), _draw_barcode, kw))
+    return bc
+
+
 def parse_color_rgb(s):
     if s is None:
         return None
@@ -115,21 +449,312 @@ def fetch_url_bytes(url):
             pass
 
 
+def image_cache_dir():
+    """On-disk store for downloaded images: $XIF_CACHE_DIR or ~/.cache/pyxml-draw/images."""
+    return os.environ.get("XIF_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "pyxml-draw", "images")
+
+
+def _write_atomic(path, data):
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+    if hasattr(os, "replace"):
+        os.replace(tmp, path)
+    else:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+
+
+FETCH_TIMEOUT = 30
+
+
+class HostSession(object):
+    """
+    One keep-alive HTTP(S) connection to a single host, reused for every URL
+    fetched through it. Not thread-safe: use one session per thread.
+    """
+
+    def __init__(self, scheme, netloc, timeout=FETCH_TIMEOUT):
+        self.scheme = scheme.lower()
+        self.netloc = netloc
+        self.timeout = timeout
+        self._conn = None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get(self, url, headers):
+        """(status, etag, last_modified, body), or None when the URL redirects."""
+        parts = urlparse.urlsplit(url)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        headers = dict(headers, **{"User-Agent": useragent_string})
+        for attempt in (0, 1):
+            if self._conn is None:
+                conn_class = httplib.HTTPSConnection if self.scheme == "https" else httplib.HTTPConnection
+                self._conn = conn_class(self.netloc, timeout=self.timeout)
+            try:
+                self._conn.request("GET", path, headers=headers)
+                resp = self._conn.getresponse()
+                body = resp.read()
+            except (httplib.HTTPException, socket.error):
+                # The server may have dropped an idle keep-alive connection; retry once.
+                self.close()
+                if attempt:
+                    raise
+                continue
+            if (resp.getheader("Connection") or "").lower() == "close":
+                self.close()
+            if resp.status in (301, 302, 303, 307, 308):
+                return None
+            if resp.status != 304 and not 200 <= resp.status < 300:
+                raise IOError("HTTP {} fetching {}".format(resp.status, url))
+            return resp.status, resp.getheader("ETag"), resp.getheader("Last-Modified"), body
+
+
+def http_get(url, headers, session=None):
+    """(status, etag, last_modified, body) for a GET, through `session` when given."""
+    if session is not None:
+        result = session.get(url, headers)
+        if result is not None:
+            return result
+    req = urllib2.Request(url)
+    req.add_header("User-Agent", useragent_string)
+    for name, value in headers.items():
+        req.add_header(name, value)
+    try:
+        resp = urllib2.urlopen(req, timeout=FETCH_TIMEOUT)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            return 304, None, None, b""
+        raise
+    try:
+        info = resp.info()
+        return resp.getcode(), info.get("ETag"), info.get("Last-Modified"), resp.read()
+    finally:
+        resp.close()
+
+
+def fetch_url_revalidated(url, session=None):
+    """
+    Fetch `url` through the on-disk store, revalidating a stored copy with
+    If-None-Match / If-Modified-Since. Returns (data, validator); the validator
+    only changes when the server sends a new body.
+    """
+    cache_dir = image_cache_dir()
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    data_path = os.path.join(cache_dir, digest + ".data")
+    meta_path = os.path.join(cache_dir, digest + ".json")
+
+    meta = None
+    if os.path.isfile(data_path) and os.path.isfile(meta_path):
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+        except Exception:
+            meta = None
+
+    headers = {}
+    if meta:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        status, etag, last_modified, data = http_get(url, headers, session)
+    except Exception:
+        # Offline or unreachable: a stored copy beats failing the render.
+        if meta:
+            with open(data_path, "rb") as f:
+                return f.read(), meta["validator"]
+        raise
+    if status == 304 and meta:
+        with open(data_path, "rb") as f:
+            return f.read(), meta["validator"]
+
+    validator = etag or last_modified or hashlib.sha1(data).hexdigest()
+    if etag or last_modified:
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            _write_atomic(data_path, data)
+            _write_atomic(meta_path, json.dumps({
+                "url": url, "etag": etag, "last_modified": last_modified, "validator": validator,
+            }).encode("utf-8"))
+        except (IOError, OSError):
+            pass
+    return data, validator
+
+
 def load_xml_tree(xif_source):
     """Load XML from file path, URL, or raw XML string."""
     if _URL_RE.match(xif_source):
-        data = fetch_url_bytes(xif_source)
-        return ET.ElementTree(ET.fromstring(data))
+        data = _profiled("fetch", urlparse.urlsplit(xif_source).netloc, fetch_url_bytes, xif_source)
+        return ET.ElementTree(_profiled("parse", "xml", ET.fromstring, data))
     if os.path.isfile(xif_source):
-        return ET.ElementTree(file=xif_source)
-    return ET.ElementTree(ET.fromstring(xif_source))
+        return _profiled("parse", "xml", ET.ElementTree, file=xif_source)
+    return ET.ElementTree(_profiled("parse", "xml", ET.fromstring, xif_source))
 
 
-def load_image_rgba(path_or_url):
+def open_xml_stream(xif_source):
+    """File object (or path) for iterparse(): file path, URL response, or raw XML string."""
+    if _URL_RE.match(xif_source):
+        req = urllib2.Request(xif_source)
+        req.add_header("User-Agent", useragent_string)
+        return urllib2.urlopen(req)
+    if os.path.isfile(xif_source):
+        return xif_source
+    return _bytes_io(xif_source.encode("utf-8") if not isinstance(xif_source, bytes) else xif_source)
+
+
+# Decoded RGBA sources and their resized variants, bounded by decoded size.
+# Remote images are only revalidated after IMAGE_REVALIDATE_SECONDS.
+_IMAGE_CACHE = LRUCache(maxbytes=128 * 1024 * 1024, sizeof=lambda entry: _image_nbytes(entry[0]))
+_SCALED_CACHE = LRUCache(maxbytes=128 * 1024 * 1024, sizeof=_image_nbytes)
+IMAGE_REVALIDATE_SECONDS = 300
+
+
+def _decode_rgba(fp):
+    return Image.open(fp).convert("RGBA")
+
+
+def _load_image_entry(path_or_url, session=None):
+    """(decoded RGBA image, source key); the key changes whenever the source does."""
     if _URL_RE.match(path_or_url):
-        data = fetch_url_bytes(path_or_url)
-        return Image.open(_bytes_io(data)).convert("RGBA")
-    return Image.open(path_or_url).convert("RGBA")
+        entry = _IMAGE_CACHE.get(path_or_url)
+        now = time.time()
+        if entry is not None and now - entry[2] < IMAGE_REVALIDATE_SECONDS:
+            return entry[0], (path_or_url, entry[1])
+        data, validator = _profiled("fetch", urlparse.urlsplit(path_or_url).netloc,
+                                    fetch_url_revalidated, path_or_url, session)
+        if entry is not None and entry[1] == validator:
+            img = entry[0]
+        else:
+            img = _profiled("image", "decode", _decode_rgba, _bytes_io(data))
+        _IMAGE_CACHE.put(path_or_url, (img, validator, now))
+        return img, (path_or_url, validator)
+
+    st = os.stat(path_or_url)
+    key = (os.path.abspath(path_or_url), st.st_mtime, st.st_size)
+    entry = _IMAGE_CACHE.get(key)
+    if entry is None:
+        entry = _IMAGE_CACHE.put(key, (_profiled("image", "decode", _decode_rgba, path_or_url), None, 0))
+    return entry[0], key
+
+
+def load_image_rgba(path_or_url):
+    """Decoded RGBA image for a file path or URL. Shared: don't modify it."""
+    return _load_image_entry(path_or_url)[0]
+
+
+def load_image_scaled(path_or_url, w=None, h=None, resizetype="nearest", mask=False):
+    """
+    load_image_rgba() resized to (w, h), memoized per (source, w, h, resample).
+    With mask=True the alpha channel is returned instead, for <bitmap>.
+    """
+    img, key = _load_image_entry(path_or_url)
+    w = w or img.size[0]
+    h = h or img.size[1]
+    if img.size == (w, h) and not mask:
+        return img
+    resample = _RESAMPLE.get((resizetype or "nearest").lower(), Image.NEAREST)
+    skey = (key, w, h, resample, mask)
+    scaled = _SCALED_CACHE.get(skey)
+    if scaled is None:
+        scaled = img if img.size == (w, h) else _profiled("image", "scale", img.resize, (w, h), resample)
+        if mask:
+            scaled = scaled.split()[-1]
+        scaled = _SCALED_CACHE.put(skey, scaled)
+    return scaled
+
+
+# Concurrent fetch pre-pass for remote pictures; PREFETCH_WORKERS = 0 disables it.
+PREFETCH_WORKERS = 8
+PREFETCH_PER_HOST = 2
+PREFETCH_DEADLINE = 60
+
+
+def collect_resource_urls(elems):
+    """Remote picture/photo/bitmap sources under the given elements, deduplicated, in document order."""
+    urls = []
+    seen = set()
+    for elem in elems:
+        for node in elem.iter():
+            if (node.tag or "").lower().strip() not in ("picture", "photo", "bitmap"):
+                continue
+            src = node.attrib.get("file", "")
+            if _URL_RE.match(src) and not _VAR_RE.search(src) and src not in seen:
+                seen.add(src)
+                urls.append(src)
+    return urls
+
+
+def prefetch_urls(urls, workers=None, per_host=None, timeout=FETCH_TIMEOUT, deadline=None):
+    """
+    Fetch and decode remote images into the image cache concurrently before
+    drawing. URLs are grouped by host and each thread keeps one keep-alive
+    connection, with at most `per_host` connections per host. Whatever has not
+    finished after `deadline` seconds is left for the serial path.
+    Returns {url: None or error message} for the URLs that were attempted.
+    """
+    workers = PREFETCH_WORKERS if workers is None else workers
+    per_host = per_host or PREFETCH_PER_HOST
+    stop_at = time.time() + (PREFETCH_DEADLINE if deadline is None else deadline)
+    if workers < 1 or not urls:
+        return {}
+
+    by_host = OrderedDict()
+    for url in urls:
+        parts = urlparse.urlsplit(url)
+        by_host.setdefault((parts.scheme, parts.netloc), []).append(url)
+    groups = queue.Queue()
+    for (scheme, netloc), host_urls in by_host.items():
+        for i in range(min(per_host, len(host_urls))):
+            groups.put((scheme, netloc, host_urls[i::per_host]))
+
+    results = {}
+
+    def fetch_group():
+        while time.time() < stop_at:
+            try:
+                scheme, netloc, group = groups.get_nowait()
+            except queue.Empty:
+                return
+            session = HostSession(scheme, netloc, timeout)
+            try:
+                for url in group:
+                    if time.time() >= stop_at:
+                        break
+                    try:
+                        _load_image_entry(url, session)
+                        results[url] = None
+                    except Exception as e:
+                        results[url] = "{}: {}".format(type(e).__name__, e)
+            finally:
+                session.close()
+
+    threads = [threading.Thread(target=fetch_group) for _ in range(min(workers, groups.qsize()))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join(max(0, stop_at - time.time()))
+    return dict(results)
+
+
+def cache_stats():
+    """Hit/miss counters for the process-wide caches."""
+    return {
+        "fonts": _FONT_CACHE.info(),
+        "barcodes": _BARCODE_CACHE.info(),
+        "images": _IMAGE_CACHE.info(),
+        "scaled_images": _SCALED_CACHE.info(),
+        "results": RESULT_CACHE.info() if RESULT_CACHE is not None else None,
+    }
 
 
 def resize_if_needed(img, w, h, resizetype):
@@ -217,119 +842,619 @@ def get_fill_outline(child, default_fill="#000000"):
     return fill, outline
 
 
-def handle_polygon(draw, base, child, root_w, root_h, resizetype):
+# One compiled draw call. `kind` picks the Pillow call; `xy` holds resolved
+# coordinates (a point list, a bbox, or an anchor); `extra` holds the
+# per-kind parameters; `resource` is the preloaded font or RGBA image.
+DrawOp = namedtuple("DrawOp", ("kind", "xy", "fill", "outline", "width", "extra", "resource"))
+
+
+# An element that references {{template variables}}: kept as parsed and only
+# compiled at render time, once its variables are bound.
+TemplateOp = namedtuple("TemplateOp", ("element", "names"))
+
+_VAR_RE = re.compile(r"\{\{\s*([A-Za-z_][\w.\-]*)\s*\}\}")
+
+
+class RenderPlan(object):
+    """
+    A compiled XIF document: canvas size, background and an immutable tuple
+    of DrawOps in document (z) order. Build with compile_xif(), draw with render().
+    A template plan also holds TemplateOps; `names` lists the variables it needs.
+    The first `base_count` ops are static and drawn under everything else, so
+    a template renders them once into a cached base raster, see base_image().
+    """
+    __slots__ = ("width", "height", "background", "ops", "resizetype", "names", "base_count", "_index", "_bases",
+                 "_rasters", "_run_boxes")
+
+    def __init__(self, width, height, background, ops, resizetype="nearest", base_count=0):
+        self.width = width
+        self.height = height
+        self.background = background
+        self.ops = tuple(ops)
+        self.resizetype = resizetype
+        names = set()
+        for op in self.ops:
+            if isinstance(op, TemplateOp):
+                names.update(op.names)
+        self.names = frozenset(names)
+        self.base_count = base_count
+        self._index = None
+        self._bases = {}
+        self._rasters = None
+        self._run_boxes = None
+
+    def spatial_index(self):
+        """SpatialIndex over the op extents, built on first use; needs a bound plan."""
+        if self._index is None:
+            if self.names:
+                raise ValueError("Bind template variables before indexing a plan.")
+            self._index = SpatialIndex([op_bbox(op) for op in self.ops], self.width, self.height)
+        return self._index
+
+    def query(self, box):
+        """
+        The ops that may touch `box`, in z order, and for each the run of shapes
+        it belongs to in the whole plan (the number of raster ops before it), so
+        a region anti-aliases the same runs as a full render, see draw_ops().
+        """
+        indices = self.spatial_index().query(box)
+        rasters = self.raster_indices()
+        return [self.ops[i] for i in indices], [bisect.bisect_left(rasters, i) for i in indices]
+
+    def raster_indices(self):
+        """Positions of the pasted raster ops, which split the anti-aliased runs of shapes."""
+        if self._rasters is None:
+            self._rasters = [i for i, op in enumerate(self.ops) if op.kind in _RASTER_KINDS]
+        return self._rasters
+
+    def run_boxes(self):
+        """
+        Extent of each run of shapes between raster ops (None for an empty
+        run), indexed like the runs of query(): run k follows the k-th raster.
+        """
+        if self._run_boxes is None:
+            boxes = [None] * (len(self.raster_indices()) + 1)
+            k = 0
+            for op in self.ops:
+                if op.kind in _RASTER_KINDS:
+                    k += 1
+                    continue
+                bb = op_bbox(op)
+                box = boxes[k]
+                boxes[k] = bb if box is None else (min(box[0], bb[0]), min(box[1], bb[1]),
+                                                   max(box[2], bb[2]), max(box[3], bb[3]))
+            self._run_boxes = boxes
+        return self._run_boxes
+
+    def base_image(self, factor=1, supersample=None):
+        """
+        The static ops drawn on the background at vector scale `factor`; made
+        once per (factor, antialiasing) and shared, so copy before drawing on it.
+        """
+        ss = max(1, SUPERSAMPLE if supersample is None else supersample)
+        key = (factor, ss, SUPERSAMPLE_FILTER if ss > 1 else None)
+        base = self._bases.get(key)
+        if base is None:
+            static = scale_plan(RenderPlan(self.width, self.height, self.background, self.ops[:self.base_count],
+                                           self.resizetype), factor)
+            base = Image.new("RGB", (static.width, static.height), color=static.background)
+            draw_ops(base, static.ops, ss)
+            self._bases[key] = base
+        return base
+
+    def __repr__(self):
+        return "<RenderPlan {}x{} ops={}{}{}>".format(
+            self.width, self.height, len(self.ops),
+            " vars=" + ",".join(sorted(self.names)) if self.names else "",
+            " static={}".format(self.base_count) if self.names and self.base_count else "")
+
+
+def template_names(elem):
+    """Names of the {{variables}} used anywhere in an element's attributes or text."""
+    names = set()
+    for node in elem.iter():
+        for value in node.attrib.values():
+            names.update(_VAR_RE.findall(value))
+        if node.text:
+            names.update(_VAR_RE.findall(node.text))
+    return frozenset(names)
+
+
+def substitute_vars(text, variables):
+    def repl(m):
+        try:
+            return "{}".format(variables[m.group(1)])
+        except KeyError:
+            raise KeyError("template variable '{}' is not bound".format(m.group(1)))
+    return _VAR_RE.sub(repl, text)
+
+
+def bind_element(elem, variables):
+    """Copy of `elem` with {{variables}} substituted; builds elements, never re-parses XML."""
+    bound = ET.Element(elem.tag, dict((k, substitute_vars(v, variables)) for k, v in elem.attrib.items()))
+    bound.text = substitute_vars(elem.text, variables) if elem.text else elem.text
+    for sub in elem:
+        bound.append(bind_element(sub, variables))
+    return bound
+
+
+def bind_ops(plan, ops, variables):
+    """`ops` (part of `plan`) with each TemplateOp compiled against `variables`."""
+    bound = dict((i, bind_element(op.element, variables))
+                 for i, op in enumerate(ops) if isinstance(op, TemplateOp))
+    prefetch_urls(collect_resource_urls(bound.values()))
+    result = []
+    for i, op in enumerate(ops):
+        if i in bound:
+            op = compile_element(bound[i], plan.width, plan.height, plan.resizetype)
+            if op is None:
+                continue
+        result.append(op)
+    return coalesce_points(result)
+
+
+def bind_plan(plan, variables):
+    """Concrete RenderPlan: only the TemplateOps are compiled, static DrawOps are shared."""
+    if not plan.names:
+        return plan
+    return RenderPlan(plan.width, plan.height, plan.background, bind_ops(plan, plan.ops, variables),
+                      plan.resizetype)
+
+
+def compile_polygon(child, root_w, root_h, resizetype):
     pts = nested_points(child, root_w, root_h)
     if not pts:
-        return
+        return None
     fill, outline = get_fill_outline(child, default_fill="#000000")
-    draw.polygon(pts, fill=fill, outline=outline)
+    return DrawOp("polygon", pts, fill, outline, None, (), None)
+
+
+def compile_line(child, root_w, root_h, resizetype):
+    pts = nested_points(child, root_w, root_h)
+    if not pts:
+        return None
+    fill, _ = get_fill_outline(child, default_fill="#000000")
+    return DrawOp("line", pts, fill, None, max(1, safe_int(child.attrib.get("width", 1), 1)), (), None)
 
 
-def handle_rectangle(draw, base, child, root_w, root_h, resizetype):
+def compile_rectangle(child, root_w, root_h, resizetype):
     bbox = inline_rect_bbox(child, root_w, root_h) or nested_bbox(child, root_w, root_h)
     if not bbox:
-        return
+        return None
     fill, outline = get_fill_outline(child, default_fill="#000000")
-    draw.rectangle(bbox, fill=fill, outline=outline)
+    return DrawOp("rectangle", bbox, fill, outline, None, (), None)
 
 
-def handle_ellipse(draw, base, child, root_w, root_h, resizetype):
+def compile_ellipse(child, root_w, root_h, resizetype):
     bbox = inline_ellipse_bbox(child, root_w, root_h) or nested_bbox(child, root_w, root_h)
     if not bbox:
-        return
+        return None
     fill, outline = get_fill_outline(child, default_fill="#000000")
-    draw.ellipse(bbox, fill=fill, outline=outline)
+    return DrawOp("ellipse", bbox, fill, outline, None, (), None)
 
 
-def handle_text(draw, base, child, root_w, root_h, resizetype):
-    # Position: inline x,y OR nested coordinates
-    pos = inline_xy(child, root_w, root_h)
-    if pos is None:
-        pts = nested_points(child, root_w, root_h)
-        pos = (pts[0], pts[1]) if len(pts) >= 2 else (0, 0)
+def compile_arc(child, root_w, root_h, resizetype):
+    """<arc>, <chord> and <pieslice>: an ellipse bbox plus start/end angles."""
+    bbox = inline_ellipse_bbox(child, root_w, root_h) or nested_bbox(child, root_w, root_h)
+    if not bbox:
+        return None
+    kind = (child.tag or "").lower().strip()
+    fill, outline = get_fill_outline(child, default_fill="#000000")
+    angles = (safe_int(child.attrib.get("start", 0)), safe_int(child.attrib.get("end", 360), 360))
+    if kind == "arc":
+        return DrawOp("arc", bbox, fill, None, max(1, safe_int(child.attrib.get("width", 1), 1)), angles, None)
+    return DrawOp(kind, bbox, fill, outline, None, angles, None)
 
+
+def packed_coords(values):
+    """Flat coordinates as a compact float array, the fastest input for ImageDraw.point()."""
+    return array.array(str("f"), values)
+
+
+def compile_point(child, root_w, root_h, resizetype):
+    """<point>/<dot>: one or more nested coordinates, or inline x,y."""
+    pos = inline_xy(child, root_w, root_h)
+    pts = pos if pos is not None else nested_points(child, root_w, root_h)
+    if not pts:
+        return None
     fill, _ = get_fill_outline(child, default_fill="#000000")
+    return DrawOp("points", packed_coords(pts), fill, None, None, (), None)
 
-    # Text content: element text OR attribute 'text'
-    txt = child.text if child.text is not None else ""
-    txt = txt.strip()
-    if not txt:
-        txt = child.attrib.get("text", "")
 
-    # Font: in your sample it's "Verdana" (not a path). truetype usually wants a path.
-    # We'll try truetype; if it fails, fall back to default font.
+def compile_points(child, root_w, root_h, resizetype):
+    """<points coords="x1,y1 x2,y2 ..."/> (or the list as element text): many pixels in one element."""
+    text = child.attrib.get("coords") or child.text or ""
+    values = packed_coords(float(v) for v in _PACKED_SPLIT_RE.split(text.strip()) if v)
+    if len(values) % 2:
+        values.pop()
+    if not values:
+        return None
+    fill, _ = get_fill_outline(child, default_fill="#000000")
+    return DrawOp("points", values, fill, None, None, (), None)
+
+
+def coalesce_points(ops):
+    """Merge runs of consecutive same-colour "points" ops into one, so they draw in a single call."""
+    pending = None
+    for op in ops:
+        if isinstance(op, DrawOp) and op.kind == "points":
+            if pending is not None and pending.fill == op.fill:
+                pending.xy.extend(op.xy)
+                continue
+            if pending is not None:
+                yield pending
+            pending = op._replace(xy=packed_coords(op.xy))
+            continue
+        if pending is not None:
+            yield pending
+            pending = None
+        yield op
+    if pending is not None:
+        yield pending
+
+
+def element_font_spec(child, root_h):
+    """(font spec, pixel size) of a text-ish element."""
     size_raw = child.attrib.get("size", "12")
     # allow percent size (relative to height)
     if _PCT_RE.match(str(size_raw).strip()):
         size = coord_value(size_raw, root_h)
     else:
         size = safe_int(size_raw, 12)
-    if size < 1:
-        size = 1
+    return child.attrib.get("font", ""), max(1, size)
+
 
-    font_spec = child.attrib.get("font", "")
+def load_text_font(font_spec, size):
+    """
+    Names such as "Verdana" are resolved via the font search path; fonts that
+    cannot be loaded fall back to Pillow's default font (and that fallback is
+    cached too, so a bad name costs one lookup).
+    """
+    if not font_spec:
+        return default_font()
     try:
-        font = ImageFont.truetype(font_spec, size) if font_spec else ImageFont.load_default()
+        return get_font(font_spec, size)
     except Exception:
-        font = ImageFont.load_default()
+        path = resolve_font_path(font_spec) or font_spec
+        return _FONT_CACHE.put((path, size, 0, None), default_font())
 
-    draw.text(pos, txt, fill=fill, font=font)
 
+def default_font(size=None):
+    """Pillow's built-in font, loaded once per size and shared; sizes need Pillow >= 10.1."""
+    font = _FONT_CACHE.get(("<default>", size))
+    if font is None:
+        try:
+            font = ImageFont.load_default(size) if size else ImageFont.load_default()
+        except TypeError:
+            font = ImageFont.load_default()
+        font = _FONT_CACHE.put(("<default>", size), font)
+    return font
 
-def handle_barcode(draw, base, child, root_w, root_h, resizetype):
-    # Support BOTH:
-    # - nested coordinates (original)
-    # - inline x,y (optional)
+
+def element_xy(child, root_w, root_h):
+    """Anchor point: inline x,y OR the first nested coordinates node."""
     pos = inline_xy(child, root_w, root_h)
     if pos is None:
         pts = nested_points(child, root_w, root_h)
         pos = (pts[0], pts[1]) if len(pts) >= 2 else (0, 0)
+    return pos
+
+
+def compile_text(child, root_w, root_h, resizetype):
+    pos = element_xy(child, root_w, root_h)
+    fill, _ = get_fill_outline(child, default_fill="#000000")
+
+    # Text content: element text OR attribute 'text'
+    txt = child.text if child.text is not None else ""
+    txt = txt.strip()
+    if not txt:
+        txt = child.attrib.get("text", "")
+
+    font_spec, size = element_font_spec(child, root_h)
+    return DrawOp("text", pos, fill, None, None, (txt, font_spec, size), load_text_font(font_spec, size))
+
+
+def compile_multilinetext(child, root_w, root_h, resizetype):
+    pos = element_xy(child, root_w, root_h)
+    fill, _ = get_fill_outline(child, default_fill="#000000")
+
+    # Text content: nested <string> nodes (one per line) OR attribute 'text'
+    lines = [s.text or "" for s in child.iter("string")]
+    txt = "\n".join(lines) if lines else child.attrib.get("text", "")
+
+    font_spec, size = element_font_spec(child, root_h)
+    extra = (txt, font_spec, size, safe_int(child.attrib.get("spacing", 4), 4), child.attrib.get("align", "left"))
+    return DrawOp("multilinetext", pos, fill, None, None, extra, load_text_font(font_spec, size))
 
+
+def barcode_kwargs(child):
+    """validate_draw_barcode() keyword arguments from a <barcode> element, or None."""
     bctype = child.attrib.get("type", "")
     code = child.attrib.get("code", "")
     if not bctype or not code:
-        return
+        return None
 
     kw = {"bctype": bctype, "upc": code}
     if "size" in child.attrib:
         kw["resize"] = safe_int(child.attrib["size"], 1)
+    if "hideinfo" in child.attrib:
+        kw["hideinfo"] = tuple(v == "1" for v in child.attrib["hideinfo"].split())
+    if "height" in child.attrib:
+        kw["barheight"] = tuple(safe_int(v) for v in child.attrib["height"].split())
+    if "textxy" in child.attrib:
+        kw["textxy"] = tuple(safe_int(v) for v in child.attrib["textxy"].split())
+    if "color" in child.attrib:
+        colors = tuple(parse_color_rgb(c) for c in child.attrib["color"].split())
+        if colors and None not in colors:
+            kw["barcolor"] = colors
+    return kw
+
+
+def compile_barcode(child, root_w, root_h, resizetype):
+    # Support BOTH:
+    # - nested coordinates (original)
+    # - inline x,y (optional)
+    pos = element_xy(child, root_w, root_h)
+
+    kw = barcode_kwargs(child)
+    if kw is None:
+        return None
+
+    return DrawOp("paste", pos, None, None, None, ("barcode", tuple(sorted(kw.items()))), get_barcode_image(**kw))
+
+
+def element_size(child, root_w, root_h):
+    """Optional inline width/height (with % support); None where absent."""
+    w = coord_value(child.attrib["width"], root_w) if "width" in child.attrib else None
+    h = coord_value(child.attrib["height"], root_h) if "height" in child.attrib else None
+    return w, h
+
 
-    bc = upcean.barcodes.shortcuts.validate_draw_barcode(**kw).convert("RGBA")
-    base.paste(bc, pos, bc)
+def compile_picture(child, root_w, root_h, resizetype):
+    src = child.attrib.get("file", "")
+    if not src:
+        return None
+    pos = element_xy(child, root_w, root_h)
+    w, h = element_size(child, root_w, root_h)
+    img = load_image_scaled(src, w, h, resizetype)
+    return DrawOp("paste", pos, None, None, None, ("image", src, img.size[0], img.size[1], resizetype), img)
 
 
-HANDLERS = {
-    "polygon": handle_polygon,
-    "rectangle": handle_rectangle,
-    "rect": handle_rectangle,
-    "square": handle_rectangle,
-    "ellipse": handle_ellipse,
-    "text": handle_text,
-    "barcode": handle_barcode,
-    # you can add the rest (arc/line/pieslice/picture/photo/bitmap/...) the same way
+def compile_bitmap(child, root_w, root_h, resizetype):
+    src = child.attrib.get("file", "")
+    if not src:
+        return None
+    pos = element_xy(child, root_w, root_h)
+    w, h = element_size(child, root_w, root_h)
+    fill, _ = get_fill_outline(child, default_fill="#000000")
+    mask = load_image_scaled(src, w, h, resizetype, mask=True)
+    return DrawOp("bitmap", pos, fill, None, None, ("image", src, mask.size[0], mask.size[1], resizetype), mask)
+
+
+COMPILERS = {
+    "polygon": compile_polygon,
+    "line": compile_line,
+    "rectangle": compile_rectangle,
+    "rect": compile_rectangle,
+    "square": compile_rectangle,
+    "ellipse": compile_ellipse,
+    "arc": compile_arc,
+    "chord": compile_arc,
+    "pieslice": compile_arc,
+    "point": compile_point,
+    "dot": compile_point,
+    "points": compile_points,
+    "text": compile_text,
+    "multilinetext": compile_multilinetext,
+    "barcode": compile_barcode,
+    "picture": compile_picture,
+    "photo": compile_picture,
+    "bitmap": compile_bitmap,
 }
 
 
-def xml_draw_image(xif_source, imgtype="png", resize=1, resizetype="nearest", outfile="output.png"):
-    tree = load_xml_tree(xif_source)
-    root = tree.getroot()
+_LAYER_TAGS = ("group", "layer")
+
+
+def layer_children(parent, dynamic=False):
+    """
+    Children of `parent` in document order with <group>/<layer> containers
+    flattened, as (element, dynamic) pairs. `dynamic` is True inside a layer
+    marked static="0", whose elements must not be baked into a base raster.
+    """
+    for child in parent:
+        if (child.tag or "").lower().strip() in _LAYER_TAGS:
+            flag = child.attrib.get("static")
+            inner = dynamic or (flag is not None and flag.strip().lower() in ("0", "false", "no"))
+            for item in layer_children(child, inner):
+                yield item
+        else:
+            yield child, dynamic
+
+
+def compile_element(child, root_w, root_h, resizetype="nearest"):
+    """Compile one child of the root <image>; None for unknown tags or empty elements."""
+    tag = (child.tag or "").lower().strip()
+    compiler = COMPILERS.get(tag)
+    if compiler is None:
+        return None
+    if PROFILER is not None:
+        with PROFILER.measure("resolve", tag):
+            return compiler(child, root_w, root_h, resizetype)
+    return compiler(child, root_w, root_h, resizetype)
+
 
+def root_canvas(root):
+    """(width, height, background RGB) from the root <image> element."""
+    if template_names(ET.Element(root.tag, root.attrib)):
+        raise ValueError("Root <image> attributes cannot use template variables.")
     root_w = safe_int(root.attrib.get("width", 0), 0)
     root_h = safe_int(root.attrib.get("height", 0), 0)
     if root_w <= 0 or root_h <= 0:
         raise ValueError("Root <image> must include positive width and height.")
-
     bg = parse_color_rgb(root.attrib.get("fill", "#FFFFFF")) or (255, 255, 255)
-    base = Image.new("RGB", (root_w, root_h), color=bg)
-    draw = ImageDraw.Draw(base, "RGBA")
+    return root_w, root_h, bg
 
-    for child in list(root):
-        tag = (child.tag or "").lower().strip()
-        handler = HANDLERS.get(tag)
-        if handler:
-            handler(draw, base, child, root_w, root_h, resizetype)
 
-    # Final integer scale
+def compile_tree(root, resizetype="nearest"):
+    """
+    Compile a parsed root <image> element into a RenderPlan.
+    Remote pictures are fetched concurrently first, see prefetch_urls().
+
+    Static elements (no {{variables}}) ahead of the first dynamic one go into
+    the plan's base, so the base is always a prefix of the document and the
+    drawing order never changes. static="0" keeps a layer, and everything
+    after it, out of the base.
+    """
+    root_w, root_h, bg = root_canvas(root)
+    prefetch_urls(collect_resource_urls([root]))
+    base = []
+    ops = []
+    for child, dynamic in layer_children(root):
+        names = template_names(child)
+        if names:
+            ops.append(TemplateOp(child, names))
+            continue
+        op = compile_element(child, root_w, root_h, resizetype)
+        if op is None:
+            continue
+        if not ops and not dynamic:
+            base.append(op)
+        else:
+            ops.append(op)
+    base = list(coalesce_points(base))
+    return RenderPlan(root_w, root_h, bg, base + list(coalesce_points(ops)), resizetype, len(base))
+
+
+def compile_xif(xif_source, resizetype="nearest"):
+    """
+    Parse and resolve an XIF document (path, URL or XML string) once:
+    colours, coordinates, fonts, barcodes and pictures are all resolved here.
+    Elements using {{variables}} are resolved per render instead, see bind_plan().
+    """
+    return compile_tree(load_xml_tree(xif_source).getroot(), resizetype)
+
+
+def _draw_paste(draw, base, op):
+    base.paste(op.resource, op.xy, op.resource)
+
+
+def _stroke(op):
+    # Outline width for shapes; only passed when scaled, so older Pillow keeps working.
+    return {"width": op.width} if op.width and op.width > 1 else {}
+
+
+_DRAWERS = {
+    "polygon": lambda draw, base, op: draw.polygon(op.xy, fill=op.fill, outline=op.outline, **_stroke(op)),
+    "line": lambda draw, base, op: draw.line(op.xy, fill=op.fill, width=op.width),
+    "points": lambda draw, base, op: draw.point(op.xy, fill=op.fill),
+    "rectangle": lambda draw, base, op: draw.rectangle(op.xy, fill=op.fill, outline=op.outline, **_stroke(op)),
+    "ellipse": lambda draw, base, op: draw.ellipse(op.xy, fill=op.fill, outline=op.outline, **_stroke(op)),
+    "arc": lambda draw, base, op: draw.arc(op.xy, op.extra[0], op.extra[1], fill=op.fill, width=op.width),
+    "chord": lambda draw, base, op: draw.chord(op.xy, op.extra[0], op.extra[1], fill=op.fill, outline=op.outline,
+                                               **_stroke(op)),
+    "pieslice": lambda draw, base, op: draw.pieslice(op.xy, op.extra[0], op.extra[1], fill=op.fill,
+                                                     outline=op.outline, **_stroke(op)),
+    "text": lambda draw, base, op: draw.text(op.xy, op.extra[0], fill=op.fill, font=op.resource),
+    "multilinetext": lambda draw, base, op: draw.multiline_text(
+        op.xy, op.extra[0], fill=op.fill, font=op.resource, spacing=op.extra[3], align=op.extra[4]),
+    "paste": _draw_paste,
+    "bitmap": lambda draw, base, op: draw.bitmap(op.xy, op.resource, fill=op.fill),
+}
+
+
+# Supersampled anti-aliasing: shapes are drawn SUPERSAMPLE times larger and
+# reduced with SUPERSAMPLE_FILTER; 1 turns it off. Pasted rasters (barcodes,
+# pictures, bitmaps) are always drawn directly so they stay pixel-exact.
+SUPERSAMPLE = 1
+SUPERSAMPLE_FILTER = "box"
+_RASTER_KINDS = frozenset(("paste", "bitmap"))
+
+
+def _draw_supersampled(base, ops, f, ss_filter):
+    """Draw a run of shape ops over the area they cover at f x and reduce it back into `base`."""
+    x0 = y0 = None
+    for op in ops:
+        bb = op_bbox(op)
+        if x0 is None:
+            x0, y0, x1, y1 = bb
+        else:
+            x0, y0, x1, y1 = min(x0, bb[0]), min(y0, bb[1]), max(x1, bb[2]), max(y1, bb[3])
+    # Starts at column 0 whatever the run's extent: Pillow rounds polygon edges
+    # from floats, so moving them sideways can move an edge pixel; moving them
+    # up or down cannot. This keeps rerender() repaints identical to a full render.
+    box = (0, max(0, y0), min(base.size[0], x1), min(base.size[1], y1))
+    if box[2] <= max(0, x0) or box[3] <= box[1]:
+        return
+    w, h = box[2] - box[0], box[3] - box[1]
+    before = base.crop(box).resize((w * f, h * f), Image.NEAREST)
+    big = before.copy()
+    draw_ops(big, [translate_op(scale_op(op, f), -box[0] * f, -box[1] * f) for op in ops], 1)
+    if (ss_filter or "box").lower() == "box":
+        # A box reduction returns untouched pixels exactly.
+        base.paste(big.resize((w, h), Image.BOX), box[:2])
+        return
+    # Other filters ring onto neighbouring pixels: only pixels the run touched change.
+    changed = ImageChops.difference(big, before).convert("L").point(lambda v: 255 if v else 0)
+    mask = changed.resize((w, h), Image.BOX).point(lambda v: 255 if v else 0)
+    resample = _RESAMPLE.get(ss_filter.lower(), _RESAMPLE["antialias"])
+    base.paste(big.resize((w, h), resample), box[:2], mask)
+
+
+def _draw_op(draw, base, op):
+    _DRAWERS[op.kind](draw, base, op)
+
+
+def _profiled_draw(draw, base, op):
+    if op.kind in _RASTER_KINDS:
+        phase, tag = "paste", op.extra[0] if op.kind == "paste" else "bitmap"
+    else:
+        phase, tag = "draw", op.kind
+    with PROFILER.measure(phase, tag):
+        _DRAWERS[op.kind](draw, base, op)
+
+
+def draw_ops(base, ops, supersample=None, ss_filter=None, runs=None):
+    """
+    Issue the Pillow calls for `ops` onto `base`, in order. With supersample
+    > 1 (default SUPERSAMPLE) runs of shapes between pasted rasters are drawn
+    anti-aliased, see _draw_supersampled(). `runs` gives each op's run in the
+    full plan when `ops` is only part of it (see RenderPlan.query()), so runs
+    also break where a raster op was left out.
+    """
+    factor = SUPERSAMPLE if supersample is None else max(1, safe_int(supersample, 1))
+    draw = ImageDraw.Draw(base, "RGBA")
+    if factor <= 1 and PROFILER is None:
+        for op in ops:
+            _DRAWERS[op.kind](draw, base, op)
+        return
+    draw_op = _profiled_draw if PROFILER is not None else _draw_op
+    if factor <= 1:
+        for op in ops:
+            draw_op(draw, base, op)
+        return
+    ss_filter = ss_filter or SUPERSAMPLE_FILTER
+    run = []
+    run_id = None
+    for i, op in enumerate(ops):
+        if op.kind not in _RASTER_KINDS:
+            if runs is not None and runs[i] != run_id:
+                if run:
+                    _profiled("draw", "supersample", _draw_supersampled, base, run, factor, ss_filter)
+                    run = []
+                run_id = runs[i]
+            run.append(op)
+            continue
+        if run:
+            _profiled("draw", "supersample", _draw_supersampled, base, run, factor, ss_filter)
+            run = []
+        draw_op(draw, base, op)
+    if run:
+        _profiled("draw", "supersample", _draw_supersampled, base, run, factor, ss_filter)
+
+
+def scale_output(base, resize=1, resizetype="nearest"):
+    """Final integer scale of a rendered canvas."""
     try:
         resize = int(resize)
     except Exception:
@@ -338,22 +1463,1786 @@ def xml_draw_image(xif_source, imgtype="png", resize=1, resizetype="nearest", ou
         resize = 1
 
     if resize > 1:
-        base = resize_if_needed(base, root_w * resize, root_h * resize, resizetype)
+        base = _profiled("resize", (resizetype or "nearest").lower(), resize_if_needed,
+                         base, base.size[0] * resize, base.size[1] * resize, resizetype)
+    return base
+
+
+def _scale_box(xy, f):
+    # Pixel (x0, y0)-(x1, y1) inclusive -> the f x f blocks those pixels become.
+    return (xy[0] * f, xy[1] * f, xy[2] * f + f - 1, xy[3] * f + f - 1)
 
-    base.save(outfile, imgtype)
+
+def _scale_points(xy, f):
+    # Vertices land on the centre of the block their pixel becomes; whole
+    # pixels keep Pillow's rasterization independent of where a tile starts.
+    c = (f - 1) // 2
+    return tuple(int(v * f + c) for v in xy)
+
+
+def scale_op(op, f):
+    """
+    `op` redrawn `f` times larger: coordinates, stroke widths, font sizes,
+    barcode module sizes and picture sizes are all multiplied, so the shape
+    is rasterized once at the target size instead of drawn small and upscaled.
+    """
+    kind = op.kind
+    if kind in ("rectangle", "ellipse", "chord", "pieslice", "arc"):
+        return op._replace(xy=_scale_box(op.xy, f), width=(op.width or 1) * f)
+    if kind == "polygon":
+        return op._replace(xy=_scale_points(op.xy, f), width=f)
+    if kind == "line":
+        return op._replace(xy=_scale_points(op.xy, f), width=op.width * f)
+    if kind == "points":
+        # Each pixel becomes an f x f block.
+        xy = op.xy
+        out = array.array(xy.typecode)
+        for x, y in zip(xy[0::2], xy[1::2]):
+            x *= f
+            y *= f
+            for dy in range(f):
+                for dx in range(f):
+                    out.append(x + dx)
+                    out.append(y + dy)
+        return op._replace(xy=out)
+    pos = (op.xy[0] * f, op.xy[1] * f)
+    if kind in ("text", "multilinetext"):
+        font_spec, size = op.extra[1], op.extra[2] * f
+        try:
+            font = get_font(font_spec, size) if font_spec else None
+        except Exception:
+            font = None
+        if font is None:
+            # Documents without a loadable font use the built-in one at its own size.
+            native = getattr(op.resource, "size", None)
+            font = default_font(native * f if native else None)
+        extra = op.extra[:2] + (size,) + ((op.extra[3] * f,) + op.extra[4:] if kind == "multilinetext" else ())
+        return op._replace(xy=pos, extra=extra, resource=font)
+    if kind == "paste" and op.extra[0] == "barcode":
+        kw = dict(op.extra[1])
+        kw["resize"] = kw.get("resize", 1) * f
+        img = get_barcode_image(**kw)
+        target = (op.resource.size[0] * f, op.resource.size[1] * f)
+        if img.size != target:
+            img = resize_if_needed(op.resource, target[0], target[1], "nearest")
+        return op._replace(xy=pos, extra=("barcode", tuple(sorted(kw.items()))), resource=img)
+    if kind in ("paste", "bitmap"):
+        _, src, w, h, resizetype = op.extra
+        img = load_image_scaled(src, w * f, h * f, resizetype, mask=(kind == "bitmap"))
+        return op._replace(xy=pos, extra=("image", src, w * f, h * f, resizetype), resource=img)
+    raise ValueError("Cannot scale a '{}' op.".format(kind))
+
+
+def scale_plan(plan, f):
+    """A bound plan drawn `f` times larger, see scale_op()."""
+    if f == 1:
+        return plan
+    return RenderPlan(plan.width * f, plan.height * f, plan.background,
+                      [scale_op(op, f) for op in plan.ops], plan.resizetype)
+
+
+def _vector_scale(resize, resizetype):
+    # (vector factor, raster resize): resizetype "vector" moves the scale into the drawing.
+    resize = max(1, safe_int(resize, 1))
+    if (resizetype or "").lower() == "vector":
+        return resize, 1
+    return 1, resize
+
+
+def render(plan, resize=1, resizetype="nearest", variables=None, supersample=None):
+    """
+    Rasterize a RenderPlan, binding `variables` for template plans; returns an
+    RGB PIL image. resizetype="vector" draws at the target size directly;
+    `supersample` (default SUPERSAMPLE) anti-aliases shapes, see draw_ops().
+    """
+    factor, resize = _vector_scale(resize, resizetype)
+    if plan.names and plan.base_count:
+        # Template: start from the cached static raster, draw only what follows it.
+        base = plan.base_image(factor, supersample).copy()
+        dynamic = RenderPlan(plan.width, plan.height, plan.background,
+                             bind_ops(plan, plan.ops[plan.base_count:], variables or {}), plan.resizetype)
+        draw_ops(base, scale_plan(dynamic, factor).ops, supersample)
+        return scale_output(base, resize, resizetype)
+    plan = bind_plan(plan, variables or {})
+    plan = scale_plan(plan, factor)
+    base = Image.new("RGB", (plan.width, plan.height), color=plan.background)
+    draw_ops(base, plan.ops, supersample)
+    return scale_output(base, resize, resizetype)
+
+
+def iter_stream(xif_source, resizetype="nearest", variables=None):
+    """
+    Parse with iterparse() and compile each child of the root as soon as it
+    closes, then discard it. Yields root_canvas() first, then the DrawOps.
+    """
+    source = open_xml_stream(xif_source)
+    root = None
+    root_w = root_h = 0
+    depth = 0
+    try:
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = elem
+                    root_w, root_h, bg = root_canvas(root)
+                    yield (root_w, root_h, bg)
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+            for child, _ in layer_children([elem]):
+                if template_names(child):
+                    child = bind_element(child, variables or {})
+                op = compile_element(child, root_w, root_h, resizetype)
+                if op is not None:
+                    yield op
+            root.clear()
+    finally:
+        if hasattr(source, "close"):
+            source.close()
+
+
+def render_stream(xif_source, resize=1, resizetype="nearest", variables=None, supersample=None):
+    """
+    Streaming render: memory follows the canvas size rather than the document
+    size. Same output as render(compile_xif(...)).
+    """
+    stream = iter_stream(xif_source, resizetype, variables)
+    for root_w, root_h, bg in stream:
+        break
+    else:
+        raise ValueError("Empty XIF document.")
+    factor, resize = _vector_scale(resize, resizetype)
+    base = Image.new("RGB", (root_w * factor, root_h * factor), color=bg)
+    ops = coalesce_points(stream)
+    if factor > 1:
+        ops = (scale_op(op, factor) for op in ops)
+    if (SUPERSAMPLE if supersample is None else safe_int(supersample, 1)) > 1:
+        # Anti-aliasing works on runs of shapes, so hold one run at a time.
+        run = []
+        for op in ops:
+            run.append(op)
+            if op.kind in _RASTER_KINDS:
+                draw_ops(base, run, supersample)
+                run = []
+        draw_ops(base, run, supersample)
+    else:
+        draw_ops(base, ops, 1)
+    return scale_output(base, resize, resizetype)
+
+
+# Tiled rendering: element extents, translation into tile space, and
+# outputs that never hold the whole canvas.
+_MEASURE = None
+
+
+def _measure_draw():
+    global _MEASURE
+    if _MEASURE is None:
+        _MEASURE = ImageDraw.Draw(Image.new("L", (1, 1)))
+    return _MEASURE
+
+
+# Per-font glyph advances for text extents; the font is kept in the entry so its id stays unique.
+_ADVANCES = LRUCache(maxitems=256)
+
+
+def text_extent(font, xy, text, spacing=4):
+    """
+    Conservative extent of text drawn at `xy`. TrueType text is bounded from
+    cached per-character advances and the font metrics plus half an em of
+    slack, which is far cheaper than laying the string out; other fonts are
+    measured exactly.
+    """
+    if not isinstance(font, ImageFont.FreeTypeFont):
+        box = _measure_draw().multiline_textbbox(xy, text, font=font, spacing=spacing)
+        return (int(box[0]) - 1, int(box[1]) - 1, int(box[2]) + 2, int(box[3]) + 2)
+    entry = _ADVANCES.get(id(font))
+    if entry is None:
+        entry = _ADVANCES.put(id(font), (font, {}))
+    advances = entry[1]
+    width = 0
+    lines = text.split("\n")
+    for line in lines:
+        line_width = 0
+        for ch in line:
+            adv = advances.get(ch)
+            if adv is None:
+                adv = advances[ch] = font.getlength(ch)
+            line_width += adv
+        width = max(width, line_width)
+    ascent, descent = font.getmetrics()
+    height = len(lines) * (ascent + descent) + (len(lines) - 1) * max(0, spacing)
+    pad = font.size // 2 + 2
+    x, y = int(xy[0]), int(xy[1])
+    return (x - pad, y - pad, x + int(width) + pad, y + height + pad)
+
+
+def op_bbox(op):
+    """
+    Conservative pixel extent (x0, y0, x1, y1) of a DrawOp, x1/y1 exclusive,
+    in canvas coordinates; padded so rounding and stroke widths stay inside.
+    """
+    kind = op.kind
+    if kind == "text":
+        return text_extent(op.resource, op.xy, op.extra[0])
+    if kind == "multilinetext":
+        return text_extent(op.resource, op.xy, op.extra[0], op.extra[3])
+    if kind in ("paste", "bitmap"):
+        x, y = int(op.xy[0]), int(op.xy[1])
+        return (x, y, x + op.resource.size[0], y + op.resource.size[1])
+    xs = op.xy[0::2]
+    ys = op.xy[1::2]
+    pad = 2 + (op.width or 0)
+    return (int(min(xs)) - pad, int(min(ys)) - pad, int(max(xs)) + pad, int(max(ys)) + pad)
+
+
+def translate_op(op, dx, dy):
+    """`op` moved by (dx, dy); every kind keeps its coordinates as a flat x,y sequence."""
+    if not dx and not dy:
+        return op
+    xy = op.xy
+    if isinstance(xy, array.array):
+        moved = array.array(xy.typecode, xy)
+        moved[0::2] = array.array(xy.typecode, [v + dx for v in xy[0::2]])
+        moved[1::2] = array.array(xy.typecode, [v + dy for v in xy[1::2]])
+        return op._replace(xy=moved)
+    return op._replace(xy=tuple(v + (dy if i % 2 else dx) for i, v in enumerate(xy)))
+
+
+def render_region(plan, box, ops=None, supersample=None, runs=None):
+    """
+    Draw the canvas area `box` = (x0, y0, x1, y1) of a bound plan at native
+    scale, using only the ops that can touch it (RenderPlan.query() by
+    default; pass its `runs` along with a subset of `ops`, see draw_ops()).
+    """
+    x0, y0, x1, y1 = box
+    img = Image.new("RGB", (x1 - x0, y1 - y0), color=plan.background)
+    if ops is None:
+        ops, runs = plan.query(box)
+    draw_ops(img, [translate_op(op, -x0, -y0) for op in ops], supersample, runs=runs)
+    return img
+
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class SpatialIndex(object):
+    """
+    Uniform grid over op extents. query(box) returns the indices of the ops
+    that may touch `box`, in z order, visiting only the cells the box covers.
+    Extents spanning more than `max_span` cells are kept in one list that
+    every query checks, so a full-page background does not fill every cell.
+    """
+
+    def __init__(self, bboxes, width, height, cell=None, max_span=256):
+        self.bboxes = bboxes
+        if cell is None:
+            cell = int((width * height / float(max(1, len(bboxes)))) ** 0.5 * 2)
+        self.cell = max(32, min(4096, cell))
+        self.cells = {}
+        self.large = []
+        c = self.cell
+        for i, bb in enumerate(bboxes):
+            cx0, cy0 = bb[0] // c, bb[1] // c
+            cx1, cy1 = (bb[2] - 1) // c, (bb[3] - 1) // c
+            if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > max_span:
+                self.large.append(i)
+                continue
+            for cy in range(cy0, cy1 + 1):
+                for cx in range(cx0, cx1 + 1):
+                    self.cells.setdefault((cx, cy), []).append(i)
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def query(self, box):
+        c = self.cell
+        bboxes = self.bboxes
+        found = set(i for i in self.large if _intersects(bboxes[i], box))
+        for cy in range(box[1] // c, (box[3] - 1) // c + 1):
+            for cx in range(box[0] // c, (box[2] - 1) // c + 1):
+                for i in self.cells.get((cx, cy), ()):
+                    if i not in found and _intersects(bboxes[i], box):
+                        found.add(i)
+        return sorted(found)
+
+
+def _render_box(plan, tx, ty, tw, th, resize, resizetype, size=None):
+    """
+    Canvas area (tx, ty, tw, th) of a bound plan, drawn from the ops the
+    spatial index returns and scaled by `resize` (or to `size`) through
+    Image.resize(box=...). The box is always drawn with a margin (wider when
+    downscaling) and cropped back, so edges match a full render; at 1:1 it
+    is only cropped, never resampled.
+    """
+    out_size = size or (tw * resize, th * resize)
+    margin = 4 * max(1, -(-tw // out_size[0]), -(-th // out_size[1]))
+    box = (max(0, tx - margin), max(0, ty - margin),
+           min(plan.width, tx + tw + margin), min(plan.height, ty + th + margin))
+    img = render_region(plan, box)
+    inner = (tx - box[0], ty - box[1], tx - box[0] + tw, ty - box[1] + th)
+    if out_size == (tw, th):
+        return img if img.size == out_size else img.crop(inner)
+    resample = _RESAMPLE.get((resizetype or "nearest").lower(), Image.NEAREST)
+    return img.resize(out_size, resample, box=inner)
+
+
+def draw_region(xif_source, box, resize=1, resizetype="nearest", variables=None, size=None):
+    """
+    Render only the canvas area `box` = (x0, y0, x1, y1) of an XIF source or
+    plan, for crop previews and pan/zoom: only the ops the spatial index finds
+    are drawn. The result is `resize` times the box, or exactly `size` (w, h)
+    for thumbnails, and matches the same area of a full render. resizetype
+    "vector" is never resampled: `size` must then be a whole multiple of the
+    box, which is drawn at that factor.
+    """
+    plan = xif_source if isinstance(xif_source, RenderPlan) else compile_xif(xif_source, resizetype)
+    plan = bind_plan(plan, variables or {})
+    x0, y0 = max(0, int(box[0])), max(0, int(box[1]))
+    x1, y1 = min(plan.width, int(box[2])), min(plan.height, int(box[3]))
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError("Region {} is outside the {}x{} canvas.".format(tuple(box), plan.width, plan.height))
+    factor, resize = _vector_scale(resize, resizetype)
+    if size and (resizetype or "").lower() == "vector":
+        factor = max(1, int(size[0]) // (x1 - x0))
+        if (int(size[0]), int(size[1])) != ((x1 - x0) * factor, (y1 - y0) * factor):
+            raise ValueError("resizetype 'vector' draws at whole scales; size {} is not a multiple of the "
+                             "{}x{} region.".format(tuple(size), x1 - x0, y1 - y0))
+    if factor > 1:
+        plan = scale_plan(plan, factor)
+        x0, y0, x1, y1 = x0 * factor, y0 * factor, x1 * factor, y1 * factor
+    return _render_box(plan, x0, y0, x1 - x0, y1 - y0, resize, resizetype, tuple(size) if size else None)
+
+
+def iter_tiles(plan, tile_width=1024, tile_height=None, resize=1, resizetype="nearest", variables=None):
+    """
+    Render a plan tile by tile, row-major. Yields ((x, y, w, h), image) with
+    the box in output pixels (after `resize`). Tile sizes are in output pixels
+    too; memory is bounded by the tile, not the canvas, and the tiles put
+    together match render() exactly.
+    """
+    plan = bind_plan(plan, variables or {})
+    factor, resize = _vector_scale(resize, resizetype)
+    plan = scale_plan(plan, factor)
+    step_w = max(1, -(-tile_width // resize))
+    step_h = max(1, -(-(tile_height or tile_width) // resize))
+    for ty in range(0, plan.height, step_h):
+        th = min(step_h, plan.height - ty)
+        for tx in range(0, plan.width, step_w):
+            tw = min(step_w, plan.width - tx)
+            yield (tx * resize, ty * resize, tw * resize, th * resize), _render_box(plan, tx, ty, tw, th, resize,
+                                                                                    resizetype)
+
+
+def xml_draw_tiles(xif_source, outdir, imgtype="png", tile_width=1024, tile_height=None, resize=1,
+                   resizetype="nearest", variables=None, pattern="tile_{row:04d}_{col:04d}.{ext}", save_options=None):
+    """
+    Render to one file per tile in `outdir`; `pattern` may use {row}, {col},
+    {x}, {y}, {w}, {h} and {ext}. Returns the written paths in row-major order.
+    """
+    plan = xif_source if isinstance(xif_source, RenderPlan) else compile_xif(xif_source, resizetype)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    ext = (imgtype or "png").lower()
+    step_w = tile_width
+    step_h = tile_height or tile_width
+    paths = []
+    for (x, y, w, h), img in iter_tiles(plan, tile_width, tile_height, resize, resizetype, variables):
+        name = pattern.format(row=y // step_h, col=x // step_w, x=x, y=y, w=w, h=h, ext=ext)
+        path = os.path.join(outdir, name)
+        encode_image(img, imgtype, path, **(save_options or {}))
+        paths.append(path)
+    return paths
+
+
+class PNGStripWriter(object):
+    """
+    Write an RGB PNG a band of rows at a time, so the full image never has to
+    exist in memory. Bands must be written top to bottom and cover the image.
+    """
+
+    def __init__(self, fileobj, width, height, compress_level=6):
+        self.fileobj = fileobj
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self._zlib = zlib.compressobj(compress_level)
+        fileobj.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, tag, data):
+        self.fileobj.write(struct.pack(">I", len(data)) + tag + data +
+                           struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+    def write_rows(self, img):
+        """Append `img` (RGB, full width) below the rows written so far."""
+        if img.size[0] != self.width or self.rows + img.size[1] > self.height:
+            raise ValueError("Band does not fit the PNG being written.")
+        raw = img.tobytes()
+        stride = self.width * 3
+        # Filter type 0 (None) before every scanline.
+        lines = b"".join(b"\x00" + raw[i:i + stride] for i in range(0, len(raw), stride))
+        data = self._zlib.compress(lines)
+        if data:
+            self._chunk(b"IDAT", data)
+        self.rows += img.size[1]
+
+    def close(self):
+        if self.rows != self.height:
+            raise ValueError("PNG closed after {} of {} rows.".format(self.rows, self.height))
+        self._chunk(b"IDAT", self._zlib.flush())
+        self._chunk(b"IEND", b"")
+
+
+def xml_draw_image_tiled(xif_source, outfile="output.png", tile_width=2048, tile_height=256, resize=1,
+                         resizetype="nearest", variables=None, compress_level=6):
+    """
+    Render a huge canvas to a single PNG in horizontal bands of `tile_height`
+    output rows, each drawn as `tile_width`-wide tiles. Peak memory is one band.
+    `outfile` is a path or writable binary file object.
+    """
+    plan = xif_source if isinstance(xif_source, RenderPlan) else compile_xif(xif_source, resizetype)
+    resize = max(1, safe_int(resize, 1))
+    out = open(outfile, "wb") if not hasattr(outfile, "write") else outfile
+    try:
+        writer = PNGStripWriter(out, plan.width * resize, plan.height * resize, compress_level)
+        band = None
+        for (x, y, w, h), img in iter_tiles(plan, tile_width, tile_height, resize, resizetype, variables):
+            if x == 0:
+                if band is not None:
+                    writer.write_rows(band)
+                band = Image.new("RGB", (writer.width, h))
+            band.paste(img, (x, 0))
+        if band is not None:
+            writer.write_rows(band)
+        writer.close()
+    finally:
+        if out is not outfile:
+            out.close()
+    return True
+
+
+# Incremental re-render: a rendered revision remembers its elements, so the
+# next revision only compiles and repaints what changed.
+class RenderedDocument(object):
+    """
+    A bound plan and its raster, drawn at vector scale `factor` (1 = native
+    size), plus a key per root child and the op each compiled to; the input
+    for rerender(). `key_memo` maps id() of the revision's elements to their
+    keys, so a revision that shares element objects with the previous one
+    (see iter_frames()) skips recomputing them; replace changed elements
+    rather than editing them in place.
+    """
+    __slots__ = ("plan", "image", "keys", "element_ops", "supersample", "key_memo", "factor")
+
+    def __init__(self, plan, image, keys, element_ops, supersample=None, key_memo=None, factor=1):
+        self.plan = plan
+        self.image = image
+        self.keys = keys
+        self.element_ops = element_ops
+        self.supersample = supersample
+        self.key_memo = key_memo or {}
+        self.factor = factor
+
+
+def _element_key(elem):
+    """Hashable value of an element: tag, attributes, text and children; tails are ignored."""
+    return (elem.tag, tuple(sorted(elem.attrib.items())), elem.text, tuple(_element_key(sub) for sub in elem))
+
+
+def _element_keys(root, variables, memo=None):
+    """
+    Keys of the drawable elements (layers flattened), with {{variables}} bound,
+    to compare revisions; returns (keys, elements, memo for this revision).
+    Keys of static elements found in `memo` are reused; templated ones are
+    always bound again, as the variables may have changed.
+    """
+    memo = memo or {}
+    keys = []
+    elems = []
+    new_memo = {}
+    for child, _ in layer_children(root):
+        entry = memo.get(id(child))
+        if entry is None or entry[0] is not child:
+            entry = (child, None if template_names(child) else _element_key(child))
+        new_memo[id(child)] = entry
+        key = entry[1]
+        if key is None:
+            child = bind_element(child, variables or {})
+            key = _element_key(child)
+        keys.append(key)
+        elems.append(child)
+    return keys, elems, new_memo
+
+
+def _compile_elements(elems, root_w, root_h, resizetype="nearest"):
+    prefetch_urls(collect_resource_urls(elems))
+    return [compile_element(elem, root_w, root_h, resizetype) for elem in elems]
+
+
+def _merge_boxes(boxes):
+    """Union overlapping or touching boxes, so each repaint covers a pixel once."""
+    merged = []
+    for box in boxes:
+        box = list(box)
+        i = 0
+        while i < len(merged):
+            other = merged[i]
+            if box[0] <= other[2] and other[0] <= box[2] and box[1] <= other[3] and other[1] <= box[3]:
+                box = [min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3])]
+                merged.pop(i)
+                i = 0
+                continue
+            i += 1
+        merged.append(box)
+    return [tuple(box) for box in merged]
+
+
+def render_document(xif_source, variables=None, supersample=None, resizetype="nearest", factor=1):
+    """
+    Render a revision (XIF source or parsed root) at native size, or drawn
+    `factor` times larger (see scale_plan()), keeping what rerender() needs.
+    """
+    root = xif_source if ET.iselement(xif_source) else load_xml_tree(xif_source).getroot()
+    root_w, root_h, bg = root_canvas(root)
+    keys, elems, memo = _element_keys(root, variables)
+    element_ops = _compile_elements(elems, root_w, root_h, resizetype)
+    plan = RenderPlan(root_w, root_h, bg, coalesce_points(op for op in element_ops if op is not None), resizetype)
+    image = render(scale_plan(plan, factor), supersample=supersample)
+    return RenderedDocument(plan, image, keys, element_ops, supersample, memo, factor)
+
+
+# Pixels rerender() draws past each dirty box and then discards.
+_REPAINT_MARGIN = 2
+
+
+def rerender(previous, xif_source, variables=None, in_place=False):
+    """
+    Update a RenderedDocument to a new revision. Elements are diffed in
+    document order; only inserted, removed or edited elements are compiled,
+    and only the union of their old and new extents is repainted (with
+    anti-aliasing, also the runs of shapes around an added or removed
+    raster), drawing whatever intersects it in z order; the result matches a
+    full render_document() of the revision pixel for pixel. Returns (RenderedDocument, dirty boxes
+    in image pixels); the document's vector `factor` is kept.
+    A changed canvas size or background renders from scratch. in_place=True
+    paints into previous.image instead of a copy. `xif_source` may also be
+    a parsed root element.
+    """
+    plan0 = previous.plan
+    f = previous.factor
+    root = xif_source if ET.iselement(xif_source) else load_xml_tree(xif_source).getroot()
+    root_w, root_h, bg = root_canvas(root)
+    if (root_w, root_h, bg) != (plan0.width, plan0.height, plan0.background):
+        doc = render_document(root, variables, previous.supersample, plan0.resizetype, f)
+        return doc, [(0, 0, root_w * f, root_h * f)]
+
+    keys, elems, memo = _element_keys(root, variables, previous.key_memo)
+    old_keys = previous.keys
+    # Common prefix and suffix first: a typical edit touches a handful of elements.
+    lo = 0
+    hi_old, hi_new = len(old_keys), len(keys)
+    while lo < hi_old and lo < hi_new and old_keys[lo] == keys[lo]:
+        lo += 1
+    while hi_old > lo and hi_new > lo and old_keys[hi_old - 1] == keys[hi_new - 1]:
+        hi_old -= 1
+        hi_new -= 1
+
+    element_ops = list(previous.element_ops[:lo])
+    dirty = []
+    rasters = set()
+    matcher = difflib.SequenceMatcher(None, old_keys[lo:hi_old], keys[lo:hi_new], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            element_ops.extend(previous.element_ops[lo + i1:lo + i2])
+            continue
+        new_ops = _compile_elements(elems[lo + j1:lo + j2], root_w, root_h, plan0.resizetype)
+        for op in list(previous.element_ops[lo + i1:lo + i2]) + new_ops:
+            if op is not None:
+                dirty.append(op_bbox(op))
+                if op.kind in _RASTER_KINDS:
+                    rasters.add(id(op))
+        element_ops.extend(new_ops)
+    element_ops.extend(previous.element_ops[hi_old:])
+
+    plan = RenderPlan(root_w, root_h, bg, coalesce_points(op for op in element_ops if op is not None),
+                      plan0.resizetype)
+    supersample = SUPERSAMPLE if previous.supersample is None else safe_int(previous.supersample, 1)
+    if rasters and supersample > 1:
+        # An added or removed raster splits or joins the anti-aliased runs
+        # around it, which changes wherever shapes of those runs overlap.
+        for p in (plan0, plan):
+            run_boxes = p.run_boxes()
+            for k, i in enumerate(p.raster_indices()):
+                if id(p.ops[i]) in rasters:
+                    dirty.extend(box for box in run_boxes[k:k + 2] if box is not None)
+    image = previous.image if in_place else previous.image.copy()
+    canvas = RenderPlan(root_w * f, root_h * f, bg, [], plan0.resizetype)
+    boxes = []
+    for box in _merge_boxes(dirty):
+        box = (max(0, box[0]), max(0, box[1]), min(root_w, box[2]), min(root_h, box[3]))
+        if box[2] > box[0] and box[3] > box[1]:
+            ops, runs = plan.query(box)
+            if f > 1:
+                # Repaint at vector scale: only the ops touching the box are scaled.
+                ops = [scale_op(op, f) for op in ops]
+                box = tuple(v * f for v in box)
+            # Pillow clips edges against the image border differently from how it
+            # draws them inside, so the repaint reaches past the box, and starts at
+            # column 0 so nothing is moved sideways (see _draw_supersampled()).
+            pad = (0, max(0, box[1] - _REPAINT_MARGIN),
+                   min(canvas.width, box[2] + _REPAINT_MARGIN), min(canvas.height, box[3] + _REPAINT_MARGIN))
+            img = render_region(canvas, pad, ops, previous.supersample, runs)
+            image.paste(img.crop((box[0] - pad[0], box[1] - pad[1], box[2] - pad[0], box[3] - pad[1])), box[:2])
+            boxes.append(box)
+    return RenderedDocument(plan, image, keys, element_ops, previous.supersample, memo, f), boxes
+
+
+def frame_roots(root, duration=100):
+    """
+    Split a multi-frame document into one root per <frame> child: the shared
+    (non-frame) elements in document order, with that frame's children in
+    place of the <frame> elements. Returns [(root, duration in ms)], using a
+    frame's duration attribute or `duration`. A document without frames is
+    one frame.
+    """
+    frames = [child for child in root if (child.tag or "").lower().strip() == "frame"]
+    if not frames:
+        return [(root, duration)]
+    result = []
+    for frame in frames:
+        sub = ET.Element(root.tag, root.attrib)
+        for child in root:
+            if child is frame:
+                sub.extend(list(child))
+            elif (child.tag or "").lower().strip() != "frame":
+                sub.append(child)
+        result.append((sub, max(1, safe_int(frame.attrib.get("duration", duration), duration))))
+    return result
+
+
+def iter_frames(xif_source, variables=None, supersample=None, resizetype="nearest", factor=1):
+    """
+    Render the frames of a multi-frame document at native size, or drawn
+    `factor` times larger (vector scale), yielding (image, duration ms,
+    repainted boxes) per frame. The first frame is drawn in full; each later
+    one starts from its predecessor and repaints only the extents of the
+    elements that differ, see rerender(), and still matches a render() of
+    that frame alone at any factor.
+    """
+    root = xif_source if ET.iselement(xif_source) else load_xml_tree(xif_source).getroot()
+    doc = None
+    for sub, duration in frame_roots(root):
+        if doc is None:
+            doc = render_document(sub, variables, supersample, resizetype, factor)
+            boxes = [(0, 0) + doc.image.size]
+        else:
+            doc, boxes = rerender(doc, sub, variables)
+        yield doc.image, duration, boxes
+
+
+# Pillow formats that can hold several frames, by -t/imgtype name.
+_MULTIFRAME_FORMATS = {"gif": "GIF", "png": "PNG", "apng": "PNG", "tif": "TIFF", "tiff": "TIFF", "webp": "WEBP"}
+
+
+def xml_draw_frames(xif_source, outfile="output.gif", imgtype="gif", resize=1, resizetype="nearest", variables=None,
+                    supersample=None, save_options=None):
+    """
+    Render a multi-frame document (see frame_roots()) in one pass and save
+    it as an animated GIF/APNG/WebP or a multi-page TIFF. The root's loop
+    attribute sets the animation repeat count (0 = forever). Returns the
+    number of frames.
+    """
+    fmt = _MULTIFRAME_FORMATS.get((imgtype or "gif").lower())
+    if fmt is None:
+        raise ValueError("{} cannot hold multiple frames; use gif, png, tiff or webp.".format(imgtype))
+    root = load_xml_tree(xif_source).getroot()
+    factor, resize = _vector_scale(resize, resizetype)
+    images = []
+    durations = []
+    for image, duration, _ in iter_frames(root, variables, supersample, resizetype, factor):
+        images.append(scale_output(image, resize, resizetype))
+        durations.append(duration)
+    options = dict(save_options or {}, save_all=True, append_images=images[1:])
+    if fmt != "TIFF":
+        options.update(duration=durations, loop=max(0, safe_int(root.attrib.get("loop", 0))))
+    encode_image(images[0], fmt, outfile, **options)
+    return len(images)
+
+
+def encode_image(img, imgtype="png", outfile=None, quality=None, optimize=None, compress_level=None, **options):
+    """
+    Encode `img` to `outfile` (a path or any writable file object such as a
+    socket file or BytesIO), or return the encoded bytes when outfile is None.
+    quality/optimize/compress_level and any other keyword go to Pillow's encoder.
+    """
+    for name, value in (("quality", quality), ("optimize", optimize), ("compress_level", compress_level)):
+        if value is not None:
+            options[name] = value
+    fmt = (imgtype or "png").upper()
+    if fmt == "JPG":
+        fmt = "JPEG"
+    if outfile is not None:
+        _profiled("encode", fmt.lower(), img.save, outfile, fmt, **options)
+        return None
+    buf = _bytes_io(b"")
+    _profiled("encode", fmt.lower(), img.save, buf, fmt, **options)
+    return buf.getvalue()
+
+
+# Content-addressed cache of encoded renders; None until enable_result_cache().
+RESULT_CACHE = None
+_FILE_DIGESTS = LRUCache(maxitems=1024)
+
+
+def result_cache_dir():
+    """On-disk result tier: $XIF_RESULT_CACHE_DIR or ~/.cache/pyxml-draw/results."""
+    return os.environ.get("XIF_RESULT_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "pyxml-draw", "results")
+
+
+class ResultCache(object):
+    """
+    Encoded images keyed by render_cache_key(): an in-memory LRU tier in front
+    of an on-disk tier, each bounded by total bytes. Disk entries are evicted
+    least recently used first (hits refresh the file's mtime), so several
+    processes can share one directory.
+    """
+
+    def __init__(self, memory_bytes=64 * 1024 * 1024, disk_bytes=512 * 1024 * 1024, cache_dir=None):
+        self.memory = LRUCache(maxbytes=memory_bytes, sizeof=len)
+        self.disk_bytes = disk_bytes
+        self.cache_dir = cache_dir or result_cache_dir()
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self.disk_evictions = 0
+        self._disk = None
+        self._disk_total = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".out")
+
+    def _disk_index(self):
+        # Existing entries, oldest first; built lazily on first disk access.
+        if self._disk is None:
+            entries = []
+            if os.path.isdir(self.cache_dir):
+                for name in os.listdir(self.cache_dir):
+                    if name.endswith(".out"):
+                        try:
+                            st = os.stat(os.path.join(self.cache_dir, name))
+                        except OSError:
+                            continue
+                        entries.append((st.st_mtime, name[:-4], st.st_size))
+            entries.sort()
+            self._disk = OrderedDict((key, size) for _, key, size in entries)
+            self._disk_total = sum(self._disk.values())
+            self._evict_disk()
+        return self._disk
+
+    def _evict_disk(self):
+        while self._disk and self._disk_total > self.disk_bytes:
+            old_key, size = self._disk.popitem(last=False)
+            self._disk_total -= size
+            self.disk_evictions += 1
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def get(self, key):
+        data = self.memory.get(key)
+        if data is not None or not self.disk_bytes:
+            return data
+        path = self._path(key)
+        with self._lock:
+            index = self._disk_index()
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path, None)
+            except (IOError, OSError):
+                self.disk_misses += 1
+                return None
+            if key not in index:
+                self._disk_total += len(data)
+            index[key] = index.pop(key, len(data))
+            self.disk_hits += 1
+        return self.memory.put(key, data)
+
+    def put(self, key, data):
+        self.memory.put(key, data)
+        if not self.disk_bytes or len(data) > self.disk_bytes:
+            return data
+        with self._lock:
+            index = self._disk_index()
+            try:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                _write_atomic(self._path(key), data)
+            except (IOError, OSError):
+                return data
+            self._disk_total += len(data) - index.pop(key, 0)
+            index[key] = len(data)
+            self._evict_disk()
+        return data
+
+    def clear(self):
+        self.memory.clear()
+        with self._lock:
+            for key in list(self._disk_index()):
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._disk.clear()
+            self._disk_total = 0
+            self.disk_hits = self.disk_misses = self.disk_evictions = 0
+
+    def info(self):
+        with self._lock:
+            disk_items = len(self._disk) if self._disk is not None else None
+            return {
+                "memory": self.memory.info(),
+                "disk": {
+                    "hits": self.disk_hits,
+                    "misses": self.disk_misses,
+                    "evictions": self.disk_evictions,
+                    "items": disk_items,
+                    "bytes": self._disk_total if self._disk is not None else None,
+                    "maxbytes": self.disk_bytes,
+                    "dir": self.cache_dir,
+                },
+            }
+
+
+def enable_result_cache(memory_bytes=64 * 1024 * 1024, disk_bytes=512 * 1024 * 1024, cache_dir=None):
+    """Turn on the process-wide result cache used by xml_draw_image(); disk_bytes=0 keeps it in memory."""
+    global RESULT_CACHE
+    RESULT_CACHE = ResultCache(memory_bytes, disk_bytes, cache_dir)
+    return RESULT_CACHE
+
+
+def file_digest(path_or_url):
+    """
+    Content identity of an external resource: sha1 of a local file (memoized
+    on path, mtime and size) or the revalidated validator of a URL.
+    """
+    if _URL_RE.match(path_or_url):
+        return "url:{}:{}".format(path_or_url, _load_image_entry(path_or_url)[1][1])
+    try:
+        st = os.stat(path_or_url)
+    except OSError:
+        return "missing:" + path_or_url
+    key = (os.path.abspath(path_or_url), st.st_mtime, st.st_size)
+    digest = _FILE_DIGESTS.get(key)
+    if digest is None:
+        h = hashlib.sha1()
+        with open(path_or_url, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+        digest = _FILE_DIGESTS.put(key, h.hexdigest())
+    return digest
+
+
+def render_cache_key(root, imgtype="png", resize=1, resizetype="nearest", variables=None, save_options=None,
+                     supersample=None):
+    """
+    sha256 over the canonicalized document (tags lowercased, attributes sorted,
+    surrounding whitespace dropped, {{variables}} substituted), the output
+    options and the digests of referenced picture/photo/bitmap files.
+    """
+    if variables:
+        root = bind_element(root, variables)
+    h = hashlib.sha256()
+    fmt = (imgtype or "png").upper()
+    supersample = SUPERSAMPLE if supersample is None else max(1, safe_int(supersample, 1))
+    options = sorted((k, v) for k, v in (save_options or {}).items() if v is not None)
+    h.update(json.dumps([__version__, "JPEG" if fmt == "JPG" else fmt, safe_int(resize, 1),
+                         (resizetype or "nearest").lower(), options,
+                         [supersample, SUPERSAMPLE_FILTER.lower()] if supersample > 1 else None],
+                        default=str).encode("utf-8"))
+    for node in root.iter():
+        tag = (node.tag or "").lower().strip()
+        attrib = sorted(node.attrib.items())
+        h.update(json.dumps([tag, attrib, (node.text or "").strip(), len(node)]).encode("utf-8"))
+        src = node.attrib.get("file")
+        if src and tag in ("picture", "photo", "bitmap"):
+            h.update(file_digest(src).encode("utf-8"))
+    return h.hexdigest()
+
+
+def cached_render_bytes(root, imgtype="png", resize=1, resizetype="nearest", variables=None, save_options=None,
+                        cache=None, supersample=None):
+    """Encoded render of a parsed root element, served from `cache` when an identical request was seen."""
+    save_options = save_options or {}
+    key = render_cache_key(root, imgtype, resize, resizetype, variables, save_options, supersample)
+    data = cache.get(key)
+    if data is None:
+        base = render(compile_tree(root, resizetype), resize, resizetype, variables, supersample)
+        data = cache.put(key, encode_image(base, imgtype, **save_options))
+    return data
+
+
+def write_output(data, outfile):
+    """Write encoded bytes to a path or a writable file object."""
+    if hasattr(outfile, "write"):
+        outfile.write(data)
+    else:
+        with open(outfile, "wb") as f:
+            f.write(data)
+
+
+def draw_image(xif_source, resize=1, resizetype="nearest", variables=None, stream=False, supersample=None):
+    """Render an XIF source or RenderPlan to an in-memory RGB PIL image."""
+    if stream and not isinstance(xif_source, RenderPlan):
+        return render_stream(xif_source, resize, resizetype, variables, supersample)
+    plan = xif_source if isinstance(xif_source, RenderPlan) else compile_xif(xif_source, resizetype)
+    return render(plan, resize, resizetype, variables, supersample)
+
+
+def xml_draw_image(xif_source, imgtype="png", resize=1, resizetype="nearest", outfile="output.png", variables=None,
+                   stream=False, save_options=None, result_cache=None, supersample=None):
+    """
+    Render an XIF source (or an already compiled RenderPlan) to `outfile`, a
+    path or writable file object. stream=True draws element by element while
+    parsing, for very large documents. `save_options` go to encode_image().
+    `result_cache` (default: RESULT_CACHE, if enabled) returns stored bytes for
+    a repeated request; plans and streamed renders bypass it. `supersample`
+    N > 1 anti-aliases shapes by drawing them N times larger (default SUPERSAMPLE).
+    """
+    cache = result_cache if result_cache is not None else RESULT_CACHE
+    if cache is not None and not stream and not isinstance(xif_source, RenderPlan):
+        root = load_xml_tree(xif_source).getroot()
+        write_output(cached_render_bytes(root, imgtype, resize, resizetype, variables, save_options, cache,
+                                         supersample), outfile)
+        return True
+    base = draw_image(xif_source, resize, resizetype, variables, stream, supersample)
+    encode_image(base, imgtype, outfile, **(save_options or {}))
     return True
 
 
+def xml_draw_image_bytes(xif_source, imgtype="png", resize=1, resizetype="nearest", variables=None,
+                         stream=False, result_cache=None, supersample=None, **save_options):
+    """Like xml_draw_image() but returns the encoded image bytes; nothing touches disk."""
+    cache = result_cache if result_cache is not None else RESULT_CACHE
+    if cache is not None and not stream and not isinstance(xif_source, RenderPlan):
+        root = load_xml_tree(xif_source).getroot()
+        return cached_render_bytes(root, imgtype, resize, resizetype, variables, save_options, cache, supersample)
+    return encode_image(draw_image(xif_source, resize, resizetype, variables, stream, supersample), imgtype,
+                        **save_options)
+
+
+def _batch_output_name(xif_source, outdir, imgtype):
+    """Derive an output filename for a batch item that did not name one."""
+    name = xif_source.rstrip("/").split("/")[-1] if _URL_RE.match(xif_source) else os.path.basename(xif_source)
+    stem = os.path.splitext(name)[0] or "output"
+    outname = stem + "." + (imgtype or "png").lower()
+    if outdir:
+        return os.path.join(outdir, outname)
+    if _URL_RE.match(xif_source):
+        return outname
+    return os.path.join(os.path.dirname(xif_source), outname)
+
+
+def iter_batch_jobs(spec, outdir=None, imgtype="png"):
+    """
+    Yield (input, output) pairs for a batch run. `spec` is one of:
+    - "-": newline-delimited paths/URLs on stdin
+    - a manifest file: one "input" or "input<TAB>output" per line, '#' comments
+    - a glob pattern, e.g. "labels/*.xif" (a single .xif/.xml path is one job)
+    """
+    if spec == "-":
+        lines = sys.stdin
+    elif os.path.isfile(spec) and not spec.lower().endswith((".xif", ".xml")):
+        lines = open(spec, "r")
+    else:
+        lines = None
+
+    if lines is None:
+        for path in sorted(glob.glob(spec)):
+            yield (path, _batch_output_name(path, outdir, imgtype))
+        return
+
+    try:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if "\t" in line:
+                src, out = [part.strip() for part in line.split("\t", 1)]
+            else:
+                src, out = line, ""
+            if not out:
+                out = _batch_output_name(src, outdir, imgtype)
+            elif outdir and not os.path.isabs(out):
+                out = os.path.join(outdir, out)
+            yield (src, out)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+def _check_batch_source(src):
+    """Raise "No such file" for a batch input that is neither a file, a URL nor inline XML."""
+    if isinstance(src, RenderPlan) or _URL_RE.match(src) or src.lstrip().startswith("<"):
+        return
+    if not os.path.isfile(src):
+        raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), src)
+
+
+def _render_task(task):
+    """Render one batch item; returns a result dict instead of raising."""
+    index, src, out, imgtype, resize, resizetype = task[:6]
+    variables = task[6] if len(task) > 6 else None
+    started = time.time()
+    result = {"index": index, "input": src, "output": out, "ok": True, "error": None}
+    try:
+        _check_batch_source(src)
+        xml_draw_image(src, imgtype, resize, resizetype, out, variables)
+    except Exception as e:
+        result["ok"] = False
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    result["seconds"] = time.time() - started
+    return result
+
+
+def xml_draw_images(jobs, imgtype="png", resize=1, resizetype="nearest"):
+    """
+    Render many (input, output) jobs in this process.
+    Yields one result dict per job; a failing job never stops the batch.
+    """
+    for index, (src, out) in enumerate(jobs):
+        yield _render_task((index, src, out, imgtype, resize, resizetype))
+
+
+def iter_records(spec):
+    """Variable sets for a template: one JSON object per line from a file, or '-' for stdin."""
+    lines = sys.stdin if spec == "-" else open(spec, "r")
+    try:
+        for line in lines:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield json.loads(line)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+def _source_label(src):
+    """How results name a source: its path or URL, "xml" for inline XML text, "template" for a plan."""
+    if isinstance(src, RenderPlan):
+        return "template"
+    return "xml" if src.lstrip().startswith("<") else src
+
+
+def xml_draw_records(xif_source, records, imgtype="png", resize=1, resizetype="nearest", outdir=None):
+    """
+    Render one template once per variable set. The template is parsed and its
+    static elements compiled and rasterized once; each record only compiles
+    and draws its templated ones.
+    A record's optional "_output" key names its output file.
+    """
+    plan = xif_source if isinstance(xif_source, RenderPlan) else compile_xif(xif_source, resizetype)
+    label = _source_label(xif_source)
+    for index, variables in enumerate(records):
+        out = variables.get("_output") or "record-{:06d}.{}".format(index, (imgtype or "png").lower())
+        if outdir and not os.path.isabs(out):
+            out = os.path.join(outdir, out)
+        result = _render_task((index, plan, out, imgtype, resize, resizetype, variables))
+        result["input"] = "{}#{}".format(label, index)
+        yield result
+
+
+def _edge_spec(value, count):
+    """
+    Margin (count=4: top, right, bottom, left) or gutter (count=2: horizontal,
+    vertical) pixels from an int, a sequence or a "1,2,3,4" string; missing
+    values repeat as in CSS.
+    """
+    if isinstance(value, (list, tuple)):
+        values = [safe_int(v) for v in value]
+    else:
+        values = [safe_int(v) for v in str(value).replace("x", ",").split(",") if v.strip()]
+    values = values or [0]
+    if count == 2:
+        return (values[0], values[1 if len(values) > 1 else 0])
+    if len(values) == 1:
+        return (values[0],) * 4
+    if len(values) == 2:
+        return (values[0], values[1], values[0], values[1])
+    if len(values) == 3:
+        return (values[0], values[1], values[2], values[1])
+    return tuple(values[:4])
+
+
+def sheet_layout(cell_w, cell_h, columns, rows, margin=0, gutter=0):
+    """
+    (sheet width, sheet height, cell origins) of a columns x rows grid of
+    cell_w x cell_h cells, see _edge_spec() for `margin` and `gutter`. Cells
+    run left to right, then top to bottom.
+    """
+    top, right, bottom, left = _edge_spec(margin, 4)
+    gap_x, gap_y = _edge_spec(gutter, 2)
+    width = left + right + columns * cell_w + (columns - 1) * gap_x
+    height = top + bottom + rows * cell_h + (rows - 1) * gap_y
+    origins = [(left + col * (cell_w + gap_x), top + row * (cell_h + gap_y))
+               for row in range(rows) for col in range(columns)]
+    return width, height, origins
+
+
+def iter_sheets(items, columns, rows, margin=0, gutter=0, cell_size=None, resize=1, resizetype="nearest",
+                background="#FFFFFF", supersample=None):
+    """
+    Impose labels onto sheets of columns x rows cells; yields (RGB sheet image,
+    result dicts of its labels) per sheet, the last one possibly part empty.
+    `items` are (XIF source or RenderPlan, variables) pairs. A repeated source
+    is compiled once, so N records of one template share its plan and cached
+    base raster. Cells take the first label's output size unless `cell_size`
+    (w, h) is given; each label sits at its cell's top left, clipped to the cell.
+    A label that fails leaves its cell blank, or takes none while the cell size
+    is still unknown; a final (None, results) reports failures that never
+    reached a sheet.
+    """
+    plans = LRUCache(maxitems=32)
+    fill = parse_color_rgb(background) or (255, 255, 255)
+    layout = sheet = None
+    slot = 0
+    results = []
+    for index, (src, variables) in enumerate(items):
+        started = time.time()
+        name = _source_label(src)
+        result = {"index": index, "input": "{}#{}".format(name, index), "output": None, "ok": True, "error": None}
+        results.append(result)
+        try:
+            plan = src if isinstance(src, RenderPlan) else plans.get(src)
+            if plan is None:
+                _check_batch_source(src)
+                plan = plans.put(src, compile_xif(src, resizetype))
+            if layout is None:
+                scale = max(1, safe_int(resize, 1))
+                cell_w, cell_h = cell_size or (plan.width * scale, plan.height * scale)
+                layout = sheet_layout(cell_w, cell_h, columns, rows, margin, gutter)
+            label = render(plan, resize, resizetype, variables, supersample)
+        except Exception as e:
+            result["ok"] = False
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+            label = None
+        result["seconds"] = time.time() - started
+        if layout is None:
+            continue
+        if sheet is None:
+            sheet = Image.new("RGB", layout[:2], color=fill)
+        if label is not None:
+            if label.size[0] > cell_w or label.size[1] > cell_h:
+                label = label.crop((0, 0, min(label.size[0], cell_w), min(label.size[1], cell_h)))
+            sheet.paste(label, layout[2][slot])
+        slot += 1
+        if slot == len(layout[2]):
+            yield sheet, results
+            sheet, slot, results = None, 0, []
+    if sheet is not None or results:
+        yield sheet, results
+
+
+def sheet_output_name(pattern, index):
+    """
+    Output path of sheet `index` (from 0): str.format()ed with index + 1 when
+    `pattern` has a {} field, else numbered as stem-001.ext, stem-002.ext...
+    """
+    if "{" in pattern:
+        return pattern.format(index + 1)
+    stem, ext = os.path.splitext(pattern)
+    return "{}-{:03d}{}".format(stem, index + 1, ext)
+
+
+def xml_draw_sheets(items, outfile="sheet.png", imgtype="png", columns=3, rows=8, margin=0, gutter=0,
+                    cell_size=None, resize=1, resizetype="nearest", background="#FFFFFF", supersample=None,
+                    save_options=None):
+    """
+    Render `items` (see iter_sheets()) onto sheets and encode each sheet once
+    to sheet_output_name(outfile, n); nothing else touches disk. Yields one
+    result dict per label, as for batches, once its sheet is written; a failing
+    label never stops the run.
+    """
+    sheets = iter_sheets(items, columns, rows, margin, gutter, cell_size, resize, resizetype, background, supersample)
+    index = 0
+    for sheet, results in sheets:
+        if sheet is not None:
+            path = sheet_output_name(outfile, index)
+            index += 1
+            try:
+                encode_image(sheet, imgtype, path, **(save_options or {}))
+            except Exception as e:
+                for result in results:
+                    if result["ok"]:
+                        result["ok"] = False
+                        result["error"] = "{}: {}".format(type(e).__name__, e)
+            for result in results:
+                result["output"] = path
+        for result in results:
+            yield result
+
+
+def parse_font_preload(spec):
+    """'path/or/name.ttf:size' -> (font spec, size)."""
+    font_spec, _, size = spec.rpartition(":")
+    if not font_spec:
+        return (spec, 12)
+    return (font_spec, safe_int(size, 12))
+
+
+def warm_worker(fonts=()):
+    """
+    Pool initializer: run Pillow's plugin registration and draw setup once,
+    import upcean if it is installed, and preload the given (font spec, size)
+    pairs for every job in this worker.
+    """
+    Image.init()
+    ImageDraw.Draw(Image.new("RGB", (1, 1)), "RGBA")
+    try:
+        upcean_shortcuts.validate_draw_barcode
+    except ImportError:
+        pass
+    for font_spec, size in fonts:
+        try:
+            get_font(font_spec, size)
+        except Exception:
+            pass
+
+
+def xml_draw_images_parallel(jobs, imgtype="png", resize=1, resizetype="nearest",
+                             workers=None, chunksize=1, ordered=True, fonts=()):
+    """
+    Render (input, output) jobs on a pool of `workers` processes (default: one per core).
+    Results are yielded in job order, or as they finish when `ordered` is False.
+    """
+    tasks = ((index, src, out, imgtype, resize, resizetype) for index, (src, out) in enumerate(jobs))
+    pool = multiprocessing.Pool(processes=workers or None, initializer=warm_worker, initargs=(tuple(fonts),))
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for result in imap(_render_task, tasks, max(1, chunksize)):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# Render service state inside each worker process.
+_TEMPLATE_DIR = None
+_TEMPLATE_PLANS = {}
+# Largest output (width x height x (resize x antialias)^2) a service worker will draw.
+_SERVICE_MAX_PIXELS = 64 * 1024 * 1024
+_TEMPLATE_ID_RE = re.compile(r"^[A-Za-z0-9_.\-]+$")
+_CONTENT_TYPES = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "tif": "image/tiff"}
+
+
+def _service_worker_init(fonts=(), template_dir=None, result_cache=None, max_pixels=None):
+    global _TEMPLATE_DIR, _SERVICE_MAX_PIXELS
+    _TEMPLATE_DIR = template_dir
+    if max_pixels:
+        _SERVICE_MAX_PIXELS = max_pixels
+    if result_cache is not None:
+        enable_result_cache(**result_cache)
+    warm_worker(fonts)
+
+
+def template_plan(template_id):
+    """Compiled plan for <template_dir>/<template_id>.xif, recompiled when the file changes."""
+    if not _TEMPLATE_DIR or not _TEMPLATE_ID_RE.match(template_id):
+        raise KeyError(template_id)
+    path = os.path.join(_TEMPLATE_DIR, template_id + ".xif")
+    if not os.path.isfile(path):
+        raise KeyError(template_id)
+    mtime = os.path.getmtime(path)
+    cached = _TEMPLATE_PLANS.get(template_id)
+    if cached is None or cached[0] != mtime:
+        cached = _TEMPLATE_PLANS[template_id] = (mtime, compile_xif(path))
+    return cached[1]
+
+
+def _service_render(request):
+    """
+    Worker side of the render service. `request` is (kind, payload, variables,
+    imgtype, resize, resizetype, save_options, supersample) with kind "xif"
+    (payload is the document bytes) or "template" (payload is a template id).
+    Returns (200, image bytes) or (status, error message); never raises.
+    """
+    kind, payload, variables, imgtype, resize, resizetype, save_options, supersample = request
+    try:
+        scale = max(1, safe_int(resize, 1)) * max(1, SUPERSAMPLE if supersample is None else safe_int(supersample, 1))
+        if kind == "template":
+            try:
+                plan = template_plan(payload)
+            except KeyError:
+                return (404, "unknown template '{}'".format(payload))
+            width, height = plan.width, plan.height
+        else:
+            root = ET.fromstring(payload)
+            width, height, _ = root_canvas(root)
+        if width * height * scale * scale > _SERVICE_MAX_PIXELS:
+            return (413, "canvas {}x{} at scale {} exceeds the {} pixel limit".format(
+                width, height, scale, _SERVICE_MAX_PIXELS))
+        if kind == "xif" and RESULT_CACHE is not None:
+            return (200, cached_render_bytes(root, imgtype, resize, resizetype,
+                                             variables, save_options, RESULT_CACHE, supersample))
+        if kind == "xif":
+            plan = compile_tree(root, resizetype)
+        base = render(plan, resize, resizetype, variables, supersample)
+        return (200, encode_image(base, imgtype, **save_options))
+    except Exception as e:
+        return (400, "{}: {}".format(type(e).__name__, e))
+
+
+def _define_service():
+    """
+    Define RenderRequestHandler and RenderServer on first use; their HTTP base
+    classes pull in most of the standard library's networking modules.
+    """
+    global RenderRequestHandler, RenderServer
+    if "RenderServer" in globals():
+        return RenderServer
+    if PY2:
+        import BaseHTTPServer as httpserver
+        import SocketServer as socketserver
+        BrokenPool = render_timeouts = ()
+    else:
+        import concurrent.futures
+        import http.server as httpserver
+        import socketserver
+        from concurrent.futures.process import BrokenProcessPool as BrokenPool
+        render_timeouts = (concurrent.futures.TimeoutError,)
+    render_timeouts += (multiprocessing.TimeoutError,)
+
+    class RenderRequestHandler(httpserver.BaseHTTPRequestHandler):
+        """
+        GET  /health               -> JSON status
+        POST /render               -> XIF document body, image bytes back
+        POST /render/<template>    -> JSON object of template variables, image bytes back
+        Query options: type, resize, resizetype, antialias, quality, compress_level, optimize.
+        """
+        protocol_version = "HTTP/1.1"
+        server_version = "{}/{}".format(__project__, __version__.replace(" ", "-"))
+
+        def log_message(self, format, *args):
+            if not self.server.quiet:
+                httpserver.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        def _reply(self, status, body, content_type="text/plain; charset=utf-8", headers=None):
+            if not isinstance(body, bytes):
+                body = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlparse.urlsplit(self.path).path
+            if path != "/health":
+                return self._reply(404, "not found\n")
+            service = self.server
+            body = json.dumps({
+                "status": "ok",
+                "version": __version__,
+                "workers": service.workers,
+                "in_flight": service.in_flight,
+                "capacity": service.capacity,
+            }, sort_keys=True)
+            self._reply(200, body + "\n", "application/json")
+
+        def do_POST(self):
+            service = self.server
+            parts = urlparse.urlsplit(self.path)
+            query = dict(urlparse.parse_qsl(parts.query))
+            if parts.path == "/render":
+                kind, payload = "xif", None
+            elif parts.path.startswith("/render/"):
+                kind, payload = "template", parts.path[len("/render/"):]
+            else:
+                return self._reply(404, "not found\n")
+
+            length = self.headers.get("Content-Length")
+            if length is None:
+                return self._reply(411, "Content-Length required\n")
+            length = safe_int(length, -1)
+            if length < 0 or length > service.max_body:
+                self.close_connection = True
+                return self._reply(413, "request body too large\n")
+            body = self.rfile.read(length)
+
+            variables = None
+            if kind == "xif":
+                payload = body
+            elif body.strip():
+                try:
+                    variables = json.loads(body.decode("utf-8"))
+                except ValueError as e:
+                    return self._reply(400, "bad JSON variables: {}\n".format(e))
+
+            imgtype = query.get("type", "png")
+            save_options = {}
+            for name in ("quality", "compress_level"):
+                if name in query:
+                    save_options[name] = safe_int(query[name])
+            if query.get("optimize") in ("1", "true", "yes"):
+                save_options["optimize"] = True
+            supersample = safe_int(query["antialias"], 1) if "antialias" in query else None
+            request = (kind, payload, variables, imgtype, safe_int(query.get("resize", 1), 1),
+                       query.get("resizetype", "nearest"), save_options, supersample)
+
+            slot = service.acquire()
+            if slot is None:
+                return self._reply(503, "render queue full\n", headers={"Retry-After": "1"})
+            try:
+                pending = service.submit(request, slot)
+            except Exception:
+                service.release(slot)
+                raise
+            try:
+                status, result = service.wait(pending, slot)
+            except render_timeouts:
+                return self._reply(504, "render timed out\n")
+            except BrokenPool:
+                return self._reply(503, "render worker died\n", headers={"Retry-After": "1"})
+            if status != 200:
+                return self._reply(status, result + "\n")
+            self._reply(200, result, _CONTENT_TYPES.get(imgtype.lower(), "image/" + imgtype.lower()))
+
+
+    class RenderServer(socketserver.ThreadingMixIn, httpserver.HTTPServer):
+        """
+        HTTP render service backed by a pool of warm worker processes. At most
+        `queue_size` renders are queued or running; further requests get 503
+        instead of piling up. A render taking longer than `timeout` seconds gets 504;
+        it is cancelled if still queued, else holds its slot until it ends.
+        Requests whose output would exceed `max_pixels` get 413. `result_cache`
+        is a dict of enable_result_cache() arguments for the workers.
+        """
+        daemon_threads = True
+        allow_reuse_address = True
+
+        def __init__(self, address, workers=None, queue_size=None, timeout=30, template_dir=None, fonts=(),
+                     max_body=16 * 1024 * 1024, quiet=False, result_cache=None, max_pixels=None):
+            self.workers = workers or multiprocessing.cpu_count()
+            self.capacity = queue_size or self.workers * 4
+            self.timeout = timeout
+            self.max_body = max_body
+            self.quiet = quiet
+            self._active = set()
+            self._slots = threading.Lock()
+            self._initargs = (tuple(fonts), template_dir, result_cache, max_pixels)
+            self.pool = self._start_pool()
+            try:
+                httpserver.HTTPServer.__init__(self, address, RenderRequestHandler)
+            except Exception:
+                self._stop_pool(self.pool)
+                raise
+
+        def _start_pool(self):
+            if PY2:
+                return multiprocessing.Pool(self.workers, initializer=_service_worker_init,
+                                            initargs=self._initargs)
+            return concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_service_worker_init,
+                                                          initargs=self._initargs)
+
+        def _stop_pool(self, pool):
+            if PY2:
+                pool.terminate()
+                pool.join()
+            else:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+        def submit(self, request, slot):
+            """
+            Queue a render; returns its pending result, see wait(). The slot is
+            released when the render ends, however it ends, not when its client
+            gives up, so work still queued or running keeps counting against
+            `queue_size`. A pool broken by a dead worker is replaced:
+            multiprocessing.Pool would hang on it, so Python 3 uses a
+            ProcessPoolExecutor, which notices.
+            """
+            done = lambda _: self.release(slot)
+            if PY2:
+                return self.pool.apply_async(_service_render, (request,), callback=done)
+            pool = self.pool
+            try:
+                future = pool.submit(_service_render, request)
+            except BrokenPool:
+                with self._slots:
+                    if self.pool is pool:
+                        self.pool = self._start_pool()
+                        self._stop_pool(pool)
+                future = self.pool.submit(_service_render, request)
+            future.add_done_callback(done)
+            return future
+
+        def wait(self, pending, slot):
+            """(status, body) of a submit()ted render; on timeout a still-queued render is cancelled."""
+            if PY2:
+                try:
+                    return pending.get(self.timeout)
+                except multiprocessing.TimeoutError:
+                    # Pool can neither cancel a task nor report a lost one.
+                    self.release(slot)
+                    raise
+            try:
+                return pending.result(self.timeout)
+            except concurrent.futures.TimeoutError:
+                pending.cancel()
+                raise
+
+        @property
+        def in_flight(self):
+            return len(self._active)
+
+        def acquire(self):
+            """A slot token, or None when `capacity` renders are already queued or running."""
+            with self._slots:
+                if len(self._active) >= self.capacity:
+                    return None
+                slot = object()
+                self._active.add(slot)
+                return slot
+
+        def release(self, slot):
+            """Free a slot; releasing it again (a render finishing after its timeout) is a no-op."""
+            with self._slots:
+                self._active.discard(slot)
+
+        def server_close(self):
+            httpserver.HTTPServer.server_close(self)
+            self._stop_pool(self.pool)
+
+    return RenderServer
+
+
+def __getattr__(name):
+    if name in ("RenderRequestHandler", "RenderServer"):
+        _define_service()
+        return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def serve(host="127.0.0.1", port=8080, **kwargs):
+    """Run a RenderServer until interrupted; kwargs as for RenderServer."""
+    server = _define_service()((host, port), **kwargs)
+    sys.stderr.write("serving on http://{}:{}/ ({} workers)\n".format(
+        server.server_address[0], server.server_address[1], server.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def report_batch(results, stream=None):
+    """Print one line per batch result plus a summary; return the failure count."""
+    stream = stream or sys.stdout
+    done = failed = 0
+    for r in results:
+        done += 1
+        if r["ok"]:
+            stream.write("ok\t{}\t{}\t{:.1f}ms\n".format(r["input"], r["output"], r["seconds"] * 1000.0))
+        else:
+            failed += 1
+            stream.write("error\t{}\t{}\n".format(r["input"], r["error"]))
+        stream.flush()
+    sys.stderr.write("{} rendered, {} failed\n".format(done - failed, failed))
+    return failed
+
+
+def write_profile(path=None, stream=None):
+    """Finish the active profile: summary to `stream` (stderr), JSON report to `path` if given."""
+    profile = disable_profiling()
+    if profile is None:
+        return None
+    (stream or sys.stderr).write(profile.summary() + "\n")
+    if path:
+        with open(path, "w") as f:
+            json.dump(profile.report(), f, indent=2, sort_keys=True)
+    return profile
+
+
 def main():
+    global PREFETCH_WORKERS, SUPERSAMPLE, SUPERSAMPLE_FILTER
     p = argparse.ArgumentParser(add_help=True)
-    p.add_argument("-i", "--input", required=True, help="Input XML file path, URL, or raw XML string")
+    p.add_argument("-i", "--input", default=None, help="Input XML file path, URL, or raw XML string")
+    p.add_argument("-b", "--batch", default=None,
+                   help="Batch input: manifest file, glob pattern, or '-' for paths on stdin")
+    p.add_argument("-d", "--outdir", default=None, help="Output directory for batch items")
+    p.add_argument("-j", "--jobs", type=int, default=1,
+                   help="Batch worker processes (0 = one per CPU core, 1 = render in-process)")
+    p.add_argument("--chunksize", type=int, default=1, help="Batch items handed to a worker at a time")
+    p.add_argument("--unordered", action="store_true", help="Report batch results as they finish")
+    p.add_argument("--preload-font", action="append", default=[], metavar="FONT:SIZE",
+                   help="Font to load once per batch worker (repeatable)")
+    p.add_argument("--var", action="append", default=[], metavar="NAME=VALUE",
+                   help="Bind a {{template}} variable (repeatable)")
+    p.add_argument("--records", default=None,
+                   help="Render -i as a template once per JSON object per line of this file ('-' = stdin)")
+    p.add_argument("--prefetch-workers", type=int, default=PREFETCH_WORKERS,
+                   help="Threads fetching remote pictures before drawing (0 = fetch serially)")
+    p.add_argument("--stream", action="store_true",
+                   help="Draw elements while parsing (bounded memory for huge documents)")
+    p.add_argument("--tile", default=None, metavar="W[xH]",
+                   help="Render in tiles of this many output pixels: a banded PNG to -o, or files in --tile-dir")
+    p.add_argument("--tile-dir", default=None, help="Write one image per tile into this directory")
+    p.add_argument("--region", default=None, metavar="X0,Y0,X1,Y1",
+                   help="Render only this canvas area (drawing only the elements that touch it)")
+    p.add_argument("--frames", action="store_true",
+                   help="Render the <frame> children as one animated GIF/PNG/WebP or multi-page TIFF")
+    p.add_argument("--sheet", default=None, metavar="COLSxROWS",
+                   help="Impose the -b documents or --records labels onto sheets of this grid, one file per sheet")
+    p.add_argument("--margin", default="0", metavar="T[,R,B,L]", help="Sheet margins in output pixels")
+    p.add_argument("--gutter", default="0", metavar="H[,V]", help="Space between sheet cells in output pixels")
+    p.add_argument("--cell", default=None, metavar="WxH", help="Sheet cell size (default: the first label's size)")
+    p.add_argument("--serve", default=None, metavar="[HOST:]PORT",
+                   help="Run the HTTP render service (-j sets the worker count)")
+    p.add_argument("--template-dir", default=None, help="Directory of <id>.xif templates for /render/<id>")
+    p.add_argument("--queue-size", type=int, default=None, help="Max queued+running renders (default 4 per worker)")
+    p.add_argument("--timeout", type=float, default=30, help="Per-request render timeout in seconds")
+    p.add_argument("--max-megapixels", type=int, default=64,
+                   help="Reject service requests whose output (with resize/antialias) exceeds this many megapixels")
+    p.add_argument("--result-cache", nargs="?", const="", default=None, metavar="DIR",
+                   help="Reuse encoded output for identical requests (disk tier in DIR or $XIF_RESULT_CACHE_DIR)")
+    p.add_argument("--result-cache-mb", type=int, default=64, help="Result cache memory tier size in MB")
+    p.add_argument("--result-cache-disk-mb", type=int, default=512,
+                   help="Result cache disk tier size in MB (0 = memory only)")
+    p.add_argument("--profile", nargs="?", const="", default=None, metavar="FILE.json",
+                   help="Time each phase and element type in this process; summary to stderr, JSON report to FILE")
+    p.add_argument("--profile-no-alloc", action="store_true",
+                   help="Skip allocation tracing (tracemalloc slows rendering down noticeably)")
+    p.add_argument("--cache-stats", action="store_true",
+                   help="Print this process's cache hit/miss counters to stderr when done")
     p.add_argument("-t", "--outputtype", default="png", help="Output image format")
-    p.add_argument("-o", "--output", default="output.png", help="Output image filename")
+    p.add_argument("-o", "--output", default="output.png", help="Output image filename ('-' = stdout)")
+    p.add_argument("--quality", type=int, default=None, help="JPEG/WebP encoder quality")
+    p.add_argument("--compress-level", type=int, default=None, help="PNG zlib compression level (0-9)")
+    p.add_argument("--optimize", action="store_true", default=None, help="Ask the encoder to optimize output size")
     p.add_argument("-s", "--resize", default=1, help="Integer scale factor")
-    p.add_argument("-r", "--resizetype", default="nearest", help="nearest|bilinear|bicubic|antialias")
+    p.add_argument("--antialias", type=int, default=1, metavar="N",
+                   help="Supersample shapes N times and reduce (barcodes and pictures stay sharp)")
+    p.add_argument("--antialias-filter", default="box", help="box|lanczos reduction filter for --antialias")
+    p.add_argument("-r", "--resizetype", default="nearest",
+                   help="nearest|bilinear|bicubic|antialias|vector (draw at the scaled size)")
     args = p.parse_args()
+    PREFETCH_WORKERS = args.prefetch_workers
+    SUPERSAMPLE = max(1, args.antialias)
+    SUPERSAMPLE_FILTER = args.antialias_filter
+    if args.profile is not None:
+        # Worker processes keep their own timings; only this process is profiled.
+        if args.serve is not None or (args.batch is not None and args.jobs != 1):
+            p.error("--profile measures this process only; use it with -j 1 and without --serve")
+        enable_profiling(trace_memory=not args.profile_no_alloc)
+        atexit.register(write_profile, args.profile or None)
+
+    result_cache = None
+    if args.result_cache is not None:
+        result_cache = {"memory_bytes": args.result_cache_mb * 1024 * 1024,
+                        "disk_bytes": args.result_cache_disk_mb * 1024 * 1024,
+                        "cache_dir": args.result_cache or None}
+        enable_result_cache(**result_cache)
+
+    if args.serve is not None:
+        host, _, port = args.serve.rpartition(":")
+        serve(host or "127.0.0.1", safe_int(port, 8080), workers=args.jobs or None, queue_size=args.queue_size,
+              timeout=args.timeout, template_dir=args.template_dir, max_pixels=args.max_megapixels * 1024 * 1024,
+              fonts=[parse_font_preload(f) for f in args.preload_font], result_cache=result_cache)
+        return
 
-    xml_draw_image(args.input, args.outputtype, args.resize, args.resizetype, args.output)
+    if args.batch is None and args.input is None:
+        p.error("one of -i/--input, -b/--batch or --serve is required")
+
+    variables = dict(v.split("=", 1) for v in args.var if "=" in v)
+
+    if args.sheet is not None:
+        columns, _, rows = args.sheet.lower().partition("x")
+        columns, rows = safe_int(columns), safe_int(rows)
+        if columns < 1 or rows < 1:
+            p.error("--sheet takes COLSxROWS, e.g. 3x8")
+        cell_size = None
+        if args.cell:
+            cell_size = _edge_spec(args.cell, 2)
+        if args.records is not None and args.input is not None:
+            items = ((args.input, dict(variables, **record)) for record in iter_records(args.records))
+        elif args.batch is not None:
+            items = ((src, variables) for src, _ in iter_batch_jobs(args.batch))
+        else:
+            p.error("--sheet needs -i with --records, or -b")
+        save_options = {"quality": args.quality, "compress_level": args.compress_level, "optimize": args.optimize}
+        failed = report_batch(xml_draw_sheets(items, args.output, args.outputtype, columns, rows, args.margin,
+                                              args.gutter, cell_size, args.resize, args.resizetype,
+                                              save_options=save_options))
+        sys.exit(1 if failed else 0)
+
+    if args.records is not None and args.input is not None:
+        if args.outdir and not os.path.isdir(args.outdir):
+            os.makedirs(args.outdir)
+        records = iter_records(args.records)
+        if variables:
+            records = (dict(variables, **record) for record in records)
+        failed = report_batch(xml_draw_records(
+            args.input, records, args.outputtype, args.resize, args.resizetype, args.outdir))
+        sys.exit(1 if failed else 0)
+
+    if args.batch is not None:
+        if args.outdir and not os.path.isdir(args.outdir):
+            os.makedirs(args.outdir)
+        jobs = iter_batch_jobs(args.batch, args.outdir, args.outputtype)
+        if args.jobs == 1:
+            warm_worker([parse_font_preload(f) for f in args.preload_font])
+            results = xml_draw_images(jobs, args.outputtype, args.resize, args.resizetype)
+        else:
+            results = xml_draw_images_parallel(
+                jobs, args.outputtype, args.resize, args.resizetype,
+                workers=args.jobs, chunksize=args.chunksize, ordered=not args.unordered,
+                fonts=[parse_font_preload(f) for f in args.preload_font])
+        failed = report_batch(results)
+        if args.cache_stats:
+            sys.stderr.write(json.dumps(cache_stats(), sort_keys=True) + "\n")
+        sys.exit(1 if failed else 0)
+
+    save_options = {"quality": args.quality, "compress_level": args.compress_level, "optimize": args.optimize}
+    outfile = args.output
+    if outfile == "-":
+        outfile = sys.stdout if PY2 else sys.stdout.buffer
+    if args.region is not None:
+        box = [safe_int(v) for v in args.region.split(",")]
+        if len(box) != 4:
+            p.error("--region takes X0,Y0,X1,Y1")
+        img = draw_region(args.input, box, args.resize, args.resizetype, variables)
+        encode_image(img, args.outputtype, outfile, **save_options)
+        return
+    if args.frames:
+        xml_draw_frames(args.input, outfile, args.outputtype, args.resize, args.resizetype, variables,
+                        save_options=save_options)
+        return
+    if args.tile is not None:
+        tile_w, _, tile_h = args.tile.lower().partition("x")
+        tile_w = max(1, safe_int(tile_w, 1024))
+        tile_h = max(1, safe_int(tile_h, 0)) if tile_h else None
+        if args.tile_dir:
+            xml_draw_tiles(args.input, args.tile_dir, args.outputtype, tile_w, tile_h, args.resize, args.resizetype,
+                           variables, save_options=save_options)
+        elif args.outputtype.lower() == "png":
+            compress_level = 6 if args.compress_level is None else args.compress_level
+            xml_draw_image_tiled(args.input, outfile, tile_w, tile_h or 256, args.resize, args.resizetype,
+                                 variables, compress_level)
+        else:
+            p.error("--tile writes PNG to -o; use --tile-dir for other output types")
+        return
+    xml_draw_image(args.input, args.outputtype, args.resize, args.resizetype, outfile, variables,
+                   stream=args.stream, save_options=save_options)
+    if args.cache_stats:
+        sys.stderr.write(json.dumps(cache_stats(), sort_keys=True) + "\n")
 
 
 if __name__ == "__main__":
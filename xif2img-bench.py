@@ -0,0 +1,597 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark both XIF engines (xif2img.py and xif2img-alt.py) on a synthetic,
+seeded corpus, entirely offline.
+
+Each (engine, corpus kind) pair runs in a fresh worker process, so caches start
+cold and peak RSS belongs to that case alone. A case renders its document once
+(cold latency), a few warm-up times, then `--runs` timed times end to end:
+read + parse + draw + PNG encode. Results are written as JSON and can be
+compared with an earlier run:
+
+    python xif2img-bench.py -o bench-0.0.9.json
+    python xif2img-bench.py --compare bench-0.0.9.json
+
+Corpus kinds stress one element type each (polygons, points, text, barcodes,
+pictures) plus a large canvas and a mixed document; --write-corpus DIR keeps
+the generated XIF files (and the PNGs the picture documents use). The
+"startup" kind instead times whole CLI invocations (`python ENGINE -i doc -o
+out.png`) on a small pure-shape document, i.e. interpreter + import + render.
+The "antialiasN" kinds render one shape document with the alt engine's
+SUPERSAMPLE set to N (1, 2, 4), so --compare tracks the cost of anti-aliasing;
+the legacy engine has no anti-aliasing and skips them.
+
+--check runs no timings; it renders seeded documents with the alt engine in
+pieces (regions, tiles, incremental rerenders after random edits, animation
+frames) and exits
+with status 1 if any piece differs from the same area of a full render.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENGINES = OrderedDict([("legacy", "xif2img.py"), ("alt", "xif2img-alt.py")])
+KINDS = ("polygons", "points", "text", "barcodes", "pictures", "large", "mixed", "startup",
+         "antialias1", "antialias2", "antialias4")
+ANTIALIAS_PREFIX = "antialias"
+RESULTS_VERSION = 1
+
+_clock = getattr(time, "perf_counter", time.time)
+
+
+# ---------------------------------------------------------------------------
+# Corpus generator
+# ---------------------------------------------------------------------------
+
+def _color(r):
+    return "#%02x%02x%02x" % (r.randrange(256), r.randrange(256), r.randrange(256))
+
+
+def _coords(points):
+    return "".join('<coordinates x="%d" y="%d" />' % p for p in points)
+
+
+def _upc_a(r):
+    """A random UPC-A code with a valid check digit."""
+    digits = [r.randrange(10) for _ in range(11)]
+    total = 3 * sum(digits[0::2]) + sum(digits[1::2])
+    return "".join(str(d) for d in digits) + str((10 - total % 10) % 10)
+
+
+def _ean13(r):
+    digits = [r.randrange(10) for _ in range(12)]
+    total = sum(digits[0::2]) + 3 * sum(digits[1::2])
+    return "".join(str(d) for d in digits) + str((10 - total % 10) % 10)
+
+
+def _shape(r, w, h, kind=None, max_vertices=6):
+    """One random shape element in the subset both engines draw identically."""
+    kind = kind or r.choice(("polygon", "line", "rectangle", "ellipse", "arc", "pieslice", "chord"))
+    x, y = r.randrange(-40, w), r.randrange(-40, h)
+    dx, dy = r.randrange(2, max(3, w // 6)), r.randrange(2, max(3, h // 6))
+    if kind == "polygon":
+        pts = [(x + r.randrange(-dx, dx), y + r.randrange(-dy, dy)) for _ in range(r.randrange(3, max_vertices + 1))]
+        return '<polygon fill="%s" outline="%s" alpha="%d">%s</polygon>' % (
+            _color(r), _color(r), r.randrange(64, 256), _coords(pts))
+    if kind == "line":
+        return '<line fill="%s" width="%d">%s</line>' % (
+            _color(r), r.randrange(1, 8), _coords([(x, y), (x + r.randrange(-dx, dx), y + r.randrange(-dy, dy))]))
+    box = _coords([(x, y), (x + dx, y + dy)])
+    if kind in ("rectangle", "ellipse"):
+        return '<%s fill="%s" outline="%s" alpha="%d">%s</%s>' % (
+            kind, _color(r), _color(r), r.randrange(64, 256), box, kind)
+    if kind == "arc":
+        return '<arc fill="%s" start="%d" end="%d">%s</arc>' % (_color(r), r.randrange(360), r.randrange(360), box)
+    return '<%s fill="%s" outline="%s" start="%d" end="%d">%s</%s>' % (
+        kind, _color(r), _color(r), r.randrange(360), r.randrange(360), box, kind)
+
+
+def _text(r, w, h, font, n):
+    x, y = r.randrange(0, w), r.randrange(0, h)
+    if r.random() < 0.2:
+        return ('<multilinetext fill="%s" size="%d" font="%s" spacing="4" align="left">%s'
+                '<string>Label %d</string><string>SKU %06d</string></multilinetext>') % (
+            _color(r), r.randrange(8, 28), font, _coords([(x, y)]), n, r.randrange(10 ** 6))
+    return '<text fill="%s" size="%d" font="%s" text="Item %d: %s">%s</text>' % (
+        _color(r), r.randrange(8, 40), font, n, "".join(r.choice("ABCDEFGHJKLMNPQRSTUVWXYZ0123456789")
+                                                        for _ in range(r.randrange(4, 24))), _coords([(x, y)]))
+
+
+def _write_picture(path, r, size):
+    from PIL import Image
+    w, h = size
+    img = Image.frombytes("RGB", (w, h), bytes(bytearray(r.randrange(256) for _ in range(w * h * 3))))
+    img.save(path, "PNG")
+
+
+def generate_xif(kind, seed=0, scale=1.0, font="DejaVuSans", asset_dir=None):
+    """
+    A deterministic synthetic XIF document of the given corpus kind. `scale`
+    multiplies element counts (and the large canvas). "pictures" writes its
+    source PNGs into `asset_dir` (required for that kind).
+    """
+    r = random.Random("%s:%d" % (kind, seed))
+    n = lambda count: max(1, int(count * scale))
+    w, h = 800, 600
+    body = []
+    if kind == "polygons":
+        body = [_shape(r, w, h, "polygon", max_vertices=r.choice((4, 8, 32, 128))) for _ in range(n(400))]
+    elif kind == "points":
+        for i in range(n(40)):
+            body.append('<points fill="%s" coords="%s" />' % (_color(r), " ".join(
+                "%d,%d" % (r.randrange(w), r.randrange(h)) for _ in range(500))))
+            body.extend('<point fill="%s">%s</point>' % (_color(r), _coords([(r.randrange(w), r.randrange(h))]))
+                        for _ in range(25))
+    elif kind == "text":
+        body = [_text(r, w, h, font, i) for i in range(n(300))]
+    elif kind == "barcodes":
+        w, h = 1240, 1754
+        cols, rows = 4, n(10)
+        h = max(h, rows * 170 + 40)
+        for i in range(cols * rows):
+            x, y = 30 + (i % cols) * 300, 30 + (i // cols) * 170
+            code = _upc_a(r) if i % 2 == 0 else _ean13(r)
+            body.append('<barcode type="%s" code="%s" size="%d">%s</barcode>' % (
+                "upca" if i % 2 == 0 else "ean13", code, r.choice((1, 2)), _coords([(x, y)])))
+    elif kind == "pictures":
+        if asset_dir is None:
+            raise ValueError("the pictures corpus needs an asset directory")
+        sources = []
+        for i in range(4):
+            path = os.path.join(asset_dir, "picture-%d-%d.png" % (seed, i))
+            if not os.path.isfile(path):
+                _write_picture(path, r, (r.randrange(64, 400), r.randrange(64, 400)))
+            sources.append(path)
+        for _ in range(n(120)):
+            body.append('<picture file="%s" width="%d" height="%d">%s</picture>' % (
+                r.choice(sources), r.randrange(16, 300), r.randrange(16, 300),
+                _coords([(r.randrange(-50, w), r.randrange(-50, h))])))
+    elif kind.startswith(ANTIALIAS_PREFIX):
+        r = random.Random("%s:%d" % (ANTIALIAS_PREFIX, seed))
+        body = [_shape(r, w, h) for _ in range(n(300))]
+    elif kind == "startup":
+        w, h = 400, 300
+        body = [_shape(r, w, h) for _ in range(n(40))]
+    elif kind == "large":
+        w, h = int(6000 * min(scale, 2.0) ** 0.5), int(4000 * min(scale, 2.0) ** 0.5)
+        body = [_shape(r, w, h) for _ in range(n(200))]
+    elif kind == "mixed":
+        for i in range(n(300)):
+            pick = r.random()
+            if pick < 0.6:
+                body.append(_shape(r, w, h))
+            elif pick < 0.85:
+                body.append(_text(r, w, h, font, i))
+            else:
+                body.append('<point fill="%s">%s</point>' % (_color(r), _coords([(r.randrange(w), r.randrange(h))])))
+        body.append('<barcode type="upca" code="%s" size="2">%s</barcode>' % (_upc_a(r), _coords([(w // 3, h // 3)])))
+    else:
+        raise ValueError("unknown corpus kind: %s" % kind)
+    return '<image width="%d" height="%d" fill="%s">\n%s\n</image>\n' % (w, h, _color(r), "\n".join(body))
+
+
+def write_corpus(corpus_dir, kinds=KINDS, seed=0, scale=1.0, font="DejaVuSans"):
+    """Generate every kind into `corpus_dir`; returns {kind: (path, element count)}."""
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+    corpus = OrderedDict()
+    for kind in kinds:
+        xif = generate_xif(kind, seed, scale, font, asset_dir=corpus_dir)
+        path = os.path.join(corpus_dir, "%s-%d.xif" % (kind, seed))
+        with io.open(path, "w", encoding="utf-8") as f:
+            f.write(xif)
+        corpus[kind] = (path, xif.count("\n") - 2)
+    return corpus
+
+
+# ---------------------------------------------------------------------------
+# Worker (one engine, one document, fresh process)
+# ---------------------------------------------------------------------------
+
+def peak_rss_kb(children=False):
+    """Peak RSS of this process (or of its largest finished child) in KiB."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def load_engine(name):
+    import importlib.util
+    path = os.path.join(HERE, ENGINES[name])
+    spec = importlib.util.spec_from_file_location("xif2img_bench_" + name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def engine_renderer(name, module):
+    """A callable(path) -> encoded PNG bytes for the named engine."""
+    if name == "alt":
+        return lambda path: module.xml_draw_image_bytes(path, "png")
+
+    def render_legacy(path):
+        out = io.BytesIO()
+        module.xml_draw_image(path, "png", False).save(out, "png")
+        return out.getvalue()
+    return render_legacy
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def antialias_factor(kind):
+    """The SUPERSAMPLE factor of an "antialiasN" kind, None for other kinds."""
+    return int(kind[len(ANTIALIAS_PREFIX):]) if kind.startswith(ANTIALIAS_PREFIX) else None
+
+
+def run_case(engine, path, runs=20, warmup=2, supersample=None):
+    start = _clock()
+    module = load_engine(engine)
+    if supersample is not None:
+        module.SUPERSAMPLE = supersample
+    render = engine_renderer(engine, module)
+    result = {"import_ms": (_clock() - start) * 1000.0, "import_rss_kb": peak_rss_kb()}
+
+    start = _clock()
+    size = len(render(path))
+    result["cold_ms"] = (_clock() - start) * 1000.0
+    for _ in range(warmup):
+        render(path)
+    times = []
+    for _ in range(runs):
+        start = _clock()
+        render(path)
+        times.append(_clock() - start)
+    times.sort()
+    total = sum(times)
+    result.update({
+        "runs": runs,
+        "output_bytes": size,
+        "renders_per_sec": runs / total if total else None,
+        "mean_ms": total / runs * 1000.0,
+        "p50_ms": percentile(times, 50) * 1000.0,
+        "p90_ms": percentile(times, 90) * 1000.0,
+        "p99_ms": percentile(times, 99) * 1000.0,
+        "max_ms": times[-1] * 1000.0,
+        "peak_rss_kb": peak_rss_kb(),
+    })
+    return result
+
+
+def run_startup(engine, path, runs=20, warmup=2):
+    """
+    Time `runs` cold CLI renders of `path`. Peak RSS is the largest child, so
+    this must run in its own worker process (see spawn_case()).
+    """
+    outfile = os.path.join(tempfile.gettempdir(), "xif-bench-startup-%d.png" % os.getpid())
+    cmd = [sys.executable, os.path.join(HERE, ENGINES[engine]), "-i", path, "-o", outfile]
+    times = []
+    try:
+        for _ in range(warmup + runs):
+            start = _clock()
+            subprocess.check_call(cmd)
+            times.append(_clock() - start)
+        size = os.path.getsize(outfile)
+    finally:
+        if os.path.exists(outfile):
+            os.remove(outfile)
+    bare = []
+    for _ in range(max(3, runs // 4)):
+        start = _clock()
+        subprocess.check_call([sys.executable, "-c", "pass"])
+        bare.append(_clock() - start)
+    cold, times = times[0], sorted(times[warmup:])
+    total = sum(times)
+    return {
+        "runs": runs,
+        "output_bytes": size,
+        "interpreter_ms": min(bare) * 1000.0,
+        "renders_per_sec": runs / total if total else None,
+        "cold_ms": cold * 1000.0,
+        "mean_ms": total / runs * 1000.0,
+        "p50_ms": percentile(times, 50) * 1000.0,
+        "p90_ms": percentile(times, 90) * 1000.0,
+        "p99_ms": percentile(times, 99) * 1000.0,
+        "max_ms": times[-1] * 1000.0,
+        "peak_rss_kb": peak_rss_kb(children=True),
+    }
+
+
+def spawn_case(engine, kind, path, runs, warmup, timeout=None):
+    """run_case() or run_startup() in a child process; returns its result dict or {"error": ...}."""
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", engine, kind, path,
+           "--runs", str(runs), "--warmup", str(warmup)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        out, err = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        return {"error": "timed out after %ss" % timeout}
+    if proc.returncode != 0:
+        lines = err.decode("utf-8", "replace").strip().splitlines()
+        return {"error": lines[-1] if lines else "exit status %d" % proc.returncode}
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+# ---------------------------------------------------------------------------
+# Reporting and regression comparison
+# ---------------------------------------------------------------------------
+
+def _fmt(value, spec="%.1f"):
+    return "-" if value is None else spec % value
+
+
+def report(results, stream=None):
+    stream = stream or sys.stdout
+    print("%-7s %-10s %6s %9s %8s %8s %8s %8s %9s" % (
+        "engine", "kind", "elems", "renders/s", "cold ms", "p50 ms", "p90 ms", "p99 ms", "peak MB"), file=stream)
+    for case in results:
+        if "error" in case:
+            print("%-7s %-10s %6s  error: %s" % (case["engine"], case["kind"], case.get("elements", "-"),
+                                                case["error"]), file=stream)
+            continue
+        rss = case.get("peak_rss_kb")
+        print("%-7s %-10s %6d %9s %8s %8s %8s %8s %9s" % (
+            case["engine"], case["kind"], case["elements"], _fmt(case["renders_per_sec"], "%.2f"),
+            _fmt(case["cold_ms"]), _fmt(case["p50_ms"]), _fmt(case["p90_ms"]), _fmt(case["p99_ms"]),
+            _fmt(rss / 1024.0 if rss is not None else None)), file=stream)
+
+
+def compare(old, new, threshold=0.10, stream=None):
+    """
+    Print per-case changes of `new` against `old` (both results documents) and
+    return the cases whose p50 latency or peak RSS grew by more than
+    `threshold` (a fraction).
+    """
+    stream = stream or sys.stdout
+    before = dict(((c["engine"], c["kind"]), c) for c in old.get("results", []) if "error" not in c)
+    regressions = []
+    print("compared with %s, %s" % (old.get("label"), old.get("created")), file=stream)
+    for case in new.get("results", []):
+        prev = before.get((case["engine"], case["kind"]))
+        if prev is None or "error" in case:
+            continue
+        notes = []
+        for field, name in (("p50_ms", "p50"), ("p99_ms", "p99"), ("peak_rss_kb", "rss")):
+            if prev.get(field) and case.get(field) is not None:
+                change = case[field] / prev[field] - 1.0
+                notes.append("%s %+.1f%%" % (name, change * 100.0))
+                if field != "p99_ms" and change > threshold:
+                    regressions.append((case["engine"], case["kind"], name, change))
+        print("  %-7s %-10s %s" % (case["engine"], case["kind"], ", ".join(notes)), file=stream)
+    for engine, kind, name, change in regressions:
+        print("REGRESSION %s/%s: %s %+.1f%%" % (engine, kind, name, change * 100.0), file=stream)
+    return regressions
+
+
+# ---------------------------------------------------------------------------
+# Consistency checks (alt engine): partial renders must match a full render
+# ---------------------------------------------------------------------------
+
+def _check_element(r, w, h, picture, kinds=None):
+    """A random shape of one of `kinds` (default: any), or now and then a picture."""
+    if r.random() < 0.15:
+        return '<picture file="%s" width="12" height="12">%s</picture>' % (
+            picture, _coords([(r.randrange(w), r.randrange(h))]))
+    return _shape(r, w, h, r.choice(kinds) if kinds else None)
+
+
+def _check_document(parts, w, h):
+    return '<image width="%d" height="%d" fill="#ffffff">%s</image>' % (w, h, "".join(parts))
+
+
+def _differs(a, b):
+    from PIL import ImageChops
+    return a.size != b.size or ImageChops.difference(a.convert("RGB"), b.convert("RGB")).getbbox() is not None
+
+
+def check_regions(module, r, asset_dir):
+    """
+    render_region() and iter_tiles() against crops of render(), on rectangles
+    and ellipses: Pillow rounds polygon and wide-line edges from floats, so
+    those may differ by a pixel once moved to a region's origin.
+    """
+    picture = os.path.join(asset_dir, "check.png")
+    _write_picture(picture, r, (12, 12))
+    parts = [_check_element(r, 200, 150, picture, ("rectangle", "ellipse")) for _ in range(150)]
+    plan = module.compile_xif(_check_document(parts, 200, 150))
+    failures = []
+    for factor in (1, 2, 4):
+        full = module.render(plan, supersample=factor)
+        for _ in range(40):
+            x, y = r.randrange(190), r.randrange(140)
+            box = (x, y, min(200, x + r.randrange(5, 60)), min(150, y + r.randrange(5, 60)))
+            if _differs(module.render_region(plan, box, supersample=factor), full.crop(box)):
+                failures.append("supersample %d: region %r" % (factor, box))
+        saved, module.SUPERSAMPLE = module.SUPERSAMPLE, factor
+        try:
+            for (x, y, tw, th), tile in module.iter_tiles(plan, 32):
+                if _differs(tile, full.crop((x, y, x + tw, y + th))):
+                    failures.append("supersample %d: tile %r" % (factor, (x, y, tw, th)))
+        finally:
+            module.SUPERSAMPLE = saved
+    return failures
+
+
+def check_rerender(module, r, asset_dir):
+    """rerender() after random edits against render_document() of the same revision."""
+    picture = os.path.join(asset_dir, "check.png")
+    _write_picture(picture, r, (12, 12))
+    failures = []
+    for factor in (1, 2, 3):
+        for supersample in (1, 2, 3):
+            parts = [_check_element(r, 200, 150, picture) for _ in range(60)]
+            doc = module.render_document(_check_document(parts, 200, 150), supersample=supersample, factor=factor)
+            for step in range(20):
+                for _ in range(r.randrange(1, 4)):
+                    action, i = r.random(), r.randrange(len(parts))
+                    if action < 0.3:
+                        parts.insert(i, _check_element(r, 200, 150, picture))
+                    elif action < 0.6 and len(parts) > 5:
+                        parts.pop(i)
+                    else:
+                        parts[i] = _check_element(r, 200, 150, picture)
+                source = _check_document(parts, 200, 150)
+                doc, _ = module.rerender(doc, source)
+                full = module.render_document(source, supersample=supersample, factor=factor)
+                if _differs(doc.image, full.image):
+                    failures.append("factor %d, supersample %d: edit %d" % (factor, supersample, step))
+                    doc = full
+    return failures
+
+
+def check_frames(module, r, asset_dir):
+    """Each frame of iter_frames() against an independent render() of that frame's document."""
+    picture = os.path.join(asset_dir, "check.png")
+    _write_picture(picture, r, (12, 12))
+    failures = []
+    for factor in (1, 2, 3):
+        for supersample in (1, 2, 3):
+            shared = [_check_element(r, 200, 150, picture) for _ in range(40)]
+            frames = ['<frame duration="50">%s</frame>' % "".join(
+                _check_element(r, 200, 150, picture) for _ in range(r.randrange(1, 5))) for _ in range(6)]
+            at = r.randrange(len(shared))
+            root = module.load_xml_tree(_check_document(shared[:at] + frames + shared[at:], 200, 150)).getroot()
+            frames = module.iter_frames(root, supersample=supersample, resizetype="vector", factor=factor)
+            for i, ((sub, _), (image, _, _)) in enumerate(zip(module.frame_roots(root), frames)):
+                full = module.render(module.compile_tree(sub, "vector"), factor, "vector", supersample=supersample)
+                if _differs(image, full):
+                    failures.append("factor %d, supersample %d: frame %d" % (factor, supersample, i))
+    return failures
+
+
+CHECKS = OrderedDict([("regions", check_regions), ("rerender", check_rerender), ("frames", check_frames)])
+
+
+def run_checks(seed=0, stream=None):
+    """Run every consistency check on the alt engine; returns the failure count."""
+    stream = stream or sys.stdout
+    module = load_engine("alt")
+    asset_dir = tempfile.mkdtemp(prefix="xif-check-")
+    failed = 0
+    try:
+        for name, check in CHECKS.items():
+            failures = check(module, random.Random(seed), asset_dir)
+            print("%-9s %s" % (name, "FAIL (%d)" % len(failures) if failures else "ok"), file=stream)
+            for failure in failures[:10]:
+                print("  " + failure, file=stream)
+            failed += len(failures)
+    finally:
+        shutil.rmtree(asset_dir, ignore_errors=True)
+    return failed
+
+
+def engine_versions():
+    versions = {}
+    for name, filename in ENGINES.items():
+        with io.open(os.path.join(HERE, filename), encoding="utf-8") as f:
+            source = f.read()
+        for marker in ('__version__ = "', "__version_info__ = "):
+            at = source.find(marker)
+            if at >= 0:
+                versions[name] = source[at + len(marker):source.find("\n", at)].strip('"')
+                break
+    return versions
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark the XIF engines on a synthetic corpus")
+    p.add_argument("-e", "--engine", action="append", default=[], choices=list(ENGINES),
+                   help="Engine to run (repeatable, default: all)")
+    p.add_argument("-k", "--kind", action="append", default=[], choices=KINDS,
+                   help="Corpus kind to run (repeatable, default: all)")
+    p.add_argument("--runs", type=int, default=20, help="Timed renders per case")
+    p.add_argument("--warmup", type=int, default=2, help="Untimed renders after the cold one")
+    p.add_argument("--seed", type=int, default=0, help="Corpus seed")
+    p.add_argument("--scale", type=float, default=1.0, help="Multiply element counts by this")
+    p.add_argument("--font", default="DejaVuSans", help="Font name or .ttf path used by text elements")
+    p.add_argument("--timeout", type=float, default=600, help="Seconds before a case is abandoned")
+    p.add_argument("--write-corpus", default=None, metavar="DIR", help="Keep the generated corpus in DIR")
+    p.add_argument("-o", "--output", default=None, metavar="FILE.json", help="Write results to this file")
+    p.add_argument("--label", default=None, help="Name stored with the results (default: engine versions)")
+    p.add_argument("--compare", default=None, metavar="OLD.json",
+                   help="Compare with earlier results; exit status 1 on a regression")
+    p.add_argument("--threshold", type=float, default=10.0, help="Regression threshold in percent")
+    p.add_argument("--check", action="store_true",
+                   help="Check alt's partial renders (regions, tiles, rerender, frames) against full renders instead")
+    p.add_argument("--worker", nargs=3, default=None, metavar=("ENGINE", "KIND", "XIF"), help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.worker is not None:
+        engine, kind, path = args.worker
+        if kind == "startup":
+            print(json.dumps(run_startup(engine, path, args.runs, args.warmup)))
+        else:
+            print(json.dumps(run_case(engine, path, args.runs, args.warmup, antialias_factor(kind))))
+        return 0
+    if args.check:
+        return 1 if run_checks(args.seed) else 0
+
+    corpus_dir = args.write_corpus or tempfile.mkdtemp(prefix="xif-bench-")
+    try:
+        corpus = write_corpus(corpus_dir, args.kind or KINDS, args.seed, args.scale, args.font)
+        results = []
+        for kind, (path, elements) in corpus.items():
+            for engine in args.engine or list(ENGINES):
+                if engine != "alt" and antialias_factor(kind) is not None:
+                    continue
+                case = OrderedDict([("engine", engine), ("kind", kind), ("elements", elements)])
+                case.update(spawn_case(engine, kind, path, args.runs, args.warmup, args.timeout))
+                results.append(case)
+                print("%s/%s done" % (engine, kind), file=sys.stderr)
+    finally:
+        if args.write_corpus is None:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    versions = engine_versions()
+    document = OrderedDict([
+        ("version", RESULTS_VERSION),
+        ("label", args.label or " / ".join("%s %s" % item for item in sorted(versions.items()))),
+        ("created", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("engines", versions),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("settings", {"runs": args.runs, "warmup": args.warmup, "seed": args.seed, "scale": args.scale,
+                      "font": args.font}),
+        ("results", results),
+    ])
+    report(results)
+    if args.output:
+        with io.open(args.output, "w", encoding="utf-8") as f:
+            f.write(json.dumps(document, indent=2) + "\n")
+    if args.compare:
+        with io.open(args.compare, encoding="utf-8") as f:
+            if compare(json.load(f), document, args.threshold / 100.0):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,14 +18,17 @@
 from __future__ import absolute_import, division, print_function, unicode_literals, generators, with_statement, nested_scopes
 import re
 import os
+import array
+import errno
 import sys
+import glob
+import json
+import time
+import hashlib
 import argparse
-import platform
+import threading
+from collections import OrderedDict
 from PIL import Image, ImageColor, ImageDraw, ImageFont
-import upcean.validate
-import upcean.support
-import upcean.barcodes.barcode
-import upcean.barcodes.shortcuts
 try:
     import xml.etree.cElementTree as cElementTree
 except ImportError:
@@ -35,13 +38,9 @@ if(sys.version[0] == "2"):
         from cStringIO import StringIO
     except ImportError:
         from StringIO import StringIO
-    import urllib2
-    import urlparse
+    BytesIO = StringIO
 if(sys.version[0] == "3"):
     from io import StringIO, BytesIO
-    import urllib.request as urllib2
-    import urllib.parse as urlparse
-from xml.sax.saxutils import XMLGenerator
 
 '''
 http://pillow.readthedocs.org/en/latest/reference/ImageDraw.html
@@ -63,26 +62,49 @@ __project__ = "PyXML-Draw"
 __project_url__ = "https://github.com/GameMaker2k/PyXML-Draw"
 useragent_string = "Mozilla/5.0 (compatible; {proname}/{prover}; +{prourl})".format(
     proname=__project__, prover=__version__, prourl=__project_url__)
-if(platform.python_implementation() != ""):
-    useragent_string_alt = "Mozilla/5.0 ({osver}; {archtype}; +{prourl}) {pyimp}/{pyver} (KHTML, like Gecko) {proname}/{prover}".format(osver=platform.system()+" "+platform.release(
-    ), archtype=platform.machine(), prourl=__project_url__, pyimp=platform.python_implementation(), pyver=platform.python_version(), proname=__project__, prover=__version__)
-if(platform.python_implementation() == ""):
-    useragent_string_alt = "Mozilla/5.0 ({osver}; {archtype}; +{prourl}) {pyimp}/{pyver} (KHTML, like Gecko) {proname}/{prover}".format(osver=platform.system(
-    )+" "+platform.release(), archtype=platform.machine(), prourl=__project_url__, pyimp="Python", pyver=platform.python_version(), proname=__project__, prover=__version__)
-
-parser = argparse.ArgumentParser(conflict_handler="resolve", add_help=True)
-parser.add_argument("-i", "--input", default=None,
-                    help="enter name of input file")
-parser.add_argument("-t", "--outputtype", default=None,
-                    help="enter file type of output image")
-parser.add_argument("-o", "--output", default=None,
-                    help="enter name of output image")
-parser.add_argument("-s", "--resize", default=1,
-                    help="enter number to resize image")
-parser.add_argument("-r", "--resizetype", default="nearest",
-                    help="enter resize type")
-parser.add_argument("-v", "--version", action="version", version=__version__)
-getargs = parser.parse_args()
+
+'''
+Barcode, network and platform modules are only imported once a document needs
+them, so rendering plain shapes does not pay for upcean or urllib at startup.
+'''
+upcean_shortcuts = None
+urllib2 = None
+urlparse = None
+
+
+def load_upcean():
+    global upcean_shortcuts
+    if(upcean_shortcuts == None):
+        import upcean.barcodes.shortcuts
+        upcean_shortcuts = upcean.barcodes.shortcuts
+    return upcean_shortcuts
+
+
+def load_urllib():
+    global urllib2, urlparse
+    if(urllib2 == None):
+        if(sys.version[0] == "2"):
+            import urllib2
+            import urlparse
+        if(sys.version[0] == "3"):
+            import urllib.request as urllib2
+            import urllib.parse as urlparse
+    return urllib2
+
+
+def get_useragent_string_alt():
+    import platform
+    pyimp = platform.python_implementation()
+    if(pyimp == ""):
+        pyimp = "Python"
+    return "Mozilla/5.0 ({osver}; {archtype}; +{prourl}) {pyimp}/{pyver} (KHTML, like Gecko) {proname}/{prover}".format(osver=platform.system()+" "+platform.release(
+    ), archtype=platform.machine(), prourl=__project_url__, pyimp=pyimp, pyver=platform.python_version(), proname=__project__, prover=__version__)
+
+
+def __getattr__(name):
+    if(name == "useragent_string_alt"):
+        return get_useragent_string_alt()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 def colortolist(color):
@@ -128,26 +150,349 @@ def coordinate_calc(calc_num, calc_size):
     return int(calc_num)
 
 
-def xml_draw_image(xiffile, imgtype="png", outputimage=True, resize=1, resizetype="nearest", outfile=None):
-    if(not str(resize).isdigit() or resize < 1):
-        resize = 1
-    resizetype = resizetype.lower()
-    if(resizetype != "antialias" and resizetype != "bilinear" and resizetype != "bicubic" and resizetype != "nearest"):
-        resizetype = "nearest"
+ttf_font_cache = OrderedDict()
+ttf_font_cache_size = 128
+ttf_font_cache_stats = {'hits': 0, 'misses': 0}
+cache_lock = threading.Lock()
+ttf_font_index = None
+
+
+def ttf_font_search_path():
+    fontdirs = [fontdir for fontdir in os.environ.get(
+        "XIF_FONT_PATH", "").split(os.pathsep) if(fontdir != "")]
+    fontdirs = fontdirs + ["/usr/share/fonts", "/usr/local/share/fonts", os.path.expanduser("~/.fonts"), os.path.expanduser(
+        "~/.local/share/fonts"), "/Library/Fonts", "/System/Library/Fonts", os.path.expanduser("~/Library/Fonts")]
+    if(os.environ.get("WINDIR") != None):
+        fontdirs.append(os.path.join(os.environ["WINDIR"], "Fonts"))
+    return fontdirs
+
+
+def ttf_font_key(fontname):
+    fontname = os.path.basename(fontname)
+    if(re.findall("\.(ttf|otf|ttc)$", fontname.lower())):
+        fontname = fontname[:-4]
+    return re.sub("[\s_\-]+", "", fontname).lower()
+
+
+def ttf_font_resolve(fontname):
+    global ttf_font_index
+    if(os.path.isfile(fontname)):
+        return os.path.abspath(fontname)
+    if(ttf_font_index == None):
+        fontindex = {}
+        for fontdir in ttf_font_search_path():
+            for dirpath, dirnames, filenames in os.walk(fontdir):
+                for filename in sorted(filenames):
+                    if(re.findall("\.(ttf|otf|ttc)$", filename.lower())):
+                        fontindex.setdefault(ttf_font_key(
+                            filename), os.path.join(dirpath, filename))
+        ttf_font_index = fontindex
+    return ttf_font_index.get(ttf_font_key(fontname), fontname)
+
+
+def get_ttf_font(fontname, fontsize, fontindex=0, layoutengine=None):
+    fontkey = (ttf_font_resolve(fontname), int(
+        fontsize), int(fontindex), layoutengine)
+    with cache_lock:
+        if(fontkey in ttf_font_cache):
+            ttf_font_cache_stats['hits'] = ttf_font_cache_stats['hits'] + 1
+            tmp_ttf_file = ttf_font_cache.pop(fontkey)
+            ttf_font_cache[fontkey] = tmp_ttf_file
+            return tmp_ttf_file
+        ttf_font_cache_stats['misses'] = ttf_font_cache_stats['misses'] + 1
+    tmp_ttf_file = ImageFont.truetype(
+        fontkey[0], fontkey[1], index=fontkey[2], layout_engine=fontkey[3])
+    with cache_lock:
+        ttf_font_cache[fontkey] = tmp_ttf_file
+        while(len(ttf_font_cache) > ttf_font_cache_size):
+            ttf_font_cache.popitem(last=False)
+    return tmp_ttf_file
+
+
+def ttf_font_cache_info():
+    return {'hits': ttf_font_cache_stats['hits'], 'misses': ttf_font_cache_stats['misses'], 'items': len(ttf_font_cache), 'maxitems': ttf_font_cache_size}
+
+
+barcode_cache = OrderedDict()
+barcode_cache_maxbytes = 64 * 1024 * 1024
+barcode_cache_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
+
+
+def get_barcode_image(xmlbarcode):
+    barcodekey = (xmlbarcode.get('bctype'), xmlbarcode.get('upc'), xmlbarcode.get('resize'), xmlbarcode.get(
+        'hideinfo'), xmlbarcode.get('barheight'), xmlbarcode.get('textxy'), xmlbarcode.get('barcolor'))
+    with cache_lock:
+        if(barcodekey in barcode_cache):
+            barcode_cache_stats['hits'] = barcode_cache_stats['hits'] + 1
+            tmp_img_paste = barcode_cache.pop(barcodekey)
+            barcode_cache[barcodekey] = tmp_img_paste
+            return tmp_img_paste
+        barcode_cache_stats['misses'] = barcode_cache_stats['misses'] + 1
+    tmp_img_paste = load_upcean().validate_draw_barcode(
+        **xmlbarcode).convert('RGBA')
+    tmp_img_size = tmp_img_paste.size[0] * tmp_img_paste.size[1] * 4
+    if(tmp_img_size > barcode_cache_maxbytes):
+        return tmp_img_paste
+    with cache_lock:
+        if(barcodekey in barcode_cache):
+            barcode_cache_stats['bytes'] = barcode_cache_stats['bytes'] - \
+                barcode_cache[barcodekey].size[0] * barcode_cache[barcodekey].size[1] * 4
+        barcode_cache[barcodekey] = tmp_img_paste
+        barcode_cache_stats['bytes'] = barcode_cache_stats['bytes'] + tmp_img_size
+        while(barcode_cache_stats['bytes'] > barcode_cache_maxbytes):
+            oldkey, oldimg = barcode_cache.popitem(last=False)
+            barcode_cache_stats['bytes'] = barcode_cache_stats['bytes'] - \
+                oldimg.size[0] * oldimg.size[1] * 4
+    return tmp_img_paste
+
+
+def barcode_cache_info():
+    return {'hits': barcode_cache_stats['hits'], 'misses': barcode_cache_stats['misses'], 'items': len(barcode_cache), 'bytes': barcode_cache_stats['bytes'], 'maxbytes': barcode_cache_maxbytes}
+
+
+image_cache = OrderedDict()
+image_cache_maxbytes = 128 * 1024 * 1024
+image_cache_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
+image_revalidate_seconds = 300
+
+
+def image_cache_put(imagekey, imagevalue, imagesize):
+    with cache_lock:
+        if(imagekey in image_cache):
+            image_cache_stats['bytes'] = image_cache_stats['bytes'] - \
+                image_cache.pop(imagekey)[1]
+        if(imagesize > image_cache_maxbytes):
+            return imagevalue
+        image_cache[imagekey] = (imagevalue, imagesize)
+        image_cache_stats['bytes'] = image_cache_stats['bytes'] + imagesize
+        while(image_cache_stats['bytes'] > image_cache_maxbytes):
+            oldkey, oldvalue = image_cache.popitem(last=False)
+            image_cache_stats['bytes'] = image_cache_stats['bytes'] - oldvalue[1]
+    return imagevalue
+
+
+def image_cache_get(imagekey):
+    with cache_lock:
+        if(imagekey in image_cache):
+            image_cache_stats['hits'] = image_cache_stats['hits'] + 1
+            imagevalue = image_cache.pop(imagekey)
+            image_cache[imagekey] = imagevalue
+            return imagevalue[0]
+        image_cache_stats['misses'] = image_cache_stats['misses'] + 1
+    return None
+
+
+def image_cache_info():
+    return {'hits': image_cache_stats['hits'], 'misses': image_cache_stats['misses'], 'items': len(image_cache), 'bytes': image_cache_stats['bytes'], 'maxbytes': image_cache_maxbytes}
+
+
+def get_image_cache_dir():
+    if(os.environ.get("XIF_CACHE_DIR") != None):
+        return os.environ["XIF_CACHE_DIR"]
+    return os.path.join(os.path.expanduser("~"), ".cache", "pyxml-draw", "images")
+
+
+def fetch_image_url(imgurl):
+    cachedir = get_image_cache_dir()
+    cachename = hashlib.sha1(imgurl.encode("utf-8")).hexdigest()
+    cachedata = os.path.join(cachedir, cachename+".data")
+    cachemeta = os.path.join(cachedir, cachename+".json")
+    imgmeta = None
+    if(os.path.isfile(cachedata) and os.path.isfile(cachemeta)):
+        try:
+            with open(cachemeta, "r") as metafile:
+                imgmeta = json.load(metafile)
+        except ValueError:
+            imgmeta = None
+    xmlheaders = {'User-Agent': useragent_string}
+    if(imgmeta != None and imgmeta.get('etag') != None):
+        xmlheaders['If-None-Match'] = imgmeta['etag']
+    if(imgmeta != None and imgmeta.get('last_modified') != None):
+        xmlheaders['If-Modified-Since'] = imgmeta['last_modified']
+    load_urllib()
+    try:
+        imgresp = urllib2.urlopen(urllib2.Request(imgurl, None, xmlheaders))
+    except urllib2.HTTPError as e:
+        if(e.code == 304 and imgmeta != None):
+            with open(cachedata, "rb") as datafile:
+                return (datafile.read(), imgmeta['validator'])
+        raise
+    imgdata = imgresp.read()
+    imgetag = imgresp.info().get('ETag')
+    imglastmod = imgresp.info().get('Last-Modified')
+    imgresp.close()
+    imgvalidator = imgetag or imglastmod or hashlib.sha1(imgdata).hexdigest()
+    if(imgetag != None or imglastmod != None):
+        try:
+            if(not os.path.isdir(cachedir)):
+                os.makedirs(cachedir)
+            with open(cachedata, "wb") as datafile:
+                datafile.write(imgdata)
+            with open(cachemeta, "w") as metafile:
+                json.dump({'url': imgurl, 'etag': imgetag, 'last_modified': imglastmod,
+                           'validator': imgvalidator}, metafile)
+        except (IOError, OSError):
+            pass
+    return (imgdata, imgvalidator)
+
+
+def get_image_rgba(imgfile):
+    if(not os.path.isfile(imgfile) and re.findall("^(http|https)\:\/\/", imgfile)):
+        imgentry = image_cache_get(('url', imgfile))
+        if(imgentry != None and time.time() - imgentry[2] < image_revalidate_seconds):
+            return (imgentry[0], (imgfile, imgentry[1]))
+        imgdata, imgvalidator = fetch_image_url(imgfile)
+        if(imgentry != None and imgentry[1] == imgvalidator):
+            tmp_img_paste = imgentry[0]
+        else:
+            tmp_img_paste = Image.open(BytesIO(imgdata)).convert('RGBA')
+        image_cache_put(('url', imgfile), (tmp_img_paste, imgvalidator, time.time(
+        )), tmp_img_paste.size[0] * tmp_img_paste.size[1] * 4)
+        return (tmp_img_paste, (imgfile, imgvalidator))
+    imgstat = os.stat(imgfile)
+    imgkey = (os.path.abspath(imgfile), imgstat.st_mtime, imgstat.st_size)
+    tmp_img_paste = image_cache_get(('file', imgkey))
+    if(tmp_img_paste == None):
+        tmp_img_paste = Image.open(imgfile).convert('RGBA')
+        image_cache_put(('file', imgkey), tmp_img_paste,
+                        tmp_img_paste.size[0] * tmp_img_paste.size[1] * 4)
+    return (tmp_img_paste, imgkey)
+
+
+def get_image_scaled(imgfile, width, height, resizetype="nearest"):
+    tmp_img_paste, imgkey = get_image_rgba(imgfile)
+    if(tmp_img_paste.size[0] == width and tmp_img_paste.size[1] == height):
+        return tmp_img_paste
+    new_img_paste = image_cache_get(
+        ('scaled', imgkey, width, height, resizetype))
+    if(new_img_paste == None):
+        if(resizetype == "antialias"):
+            new_img_paste = tmp_img_paste.resize(
+                (width, height), getattr(Image, "LANCZOS", None) or Image.ANTIALIAS)
+        if(resizetype == "bilinear"):
+            new_img_paste = tmp_img_paste.resize(
+                (width, height), Image.BILINEAR)
+        if(resizetype == "bicubic"):
+            new_img_paste = tmp_img_paste.resize(
+                (width, height), Image.BICUBIC)
+        if(resizetype == "nearest"):
+            new_img_paste = tmp_img_paste.resize(
+                (width, height), Image.NEAREST)
+        image_cache_put(('scaled', imgkey, width, height, resizetype),
+                        new_img_paste, width * height * 4)
+    return new_img_paste
+
+
+'''
+Remote pictures and bitmaps of a loaded document are fetched before drawing,
+several at a time, so a label with five remote logos waits about one round
+trip instead of five. Failures are left for the draw loop to report.
+'''
+prefetch_max_workers = 8
+prefetch_deadline = 30
+
+
+def xml_image_urls(root):
+    imgurls = []
+    for child in root:
+        if(child.tag != "picture" and child.tag != "photo" and child.tag != "bitmap"):
+            continue
+        imgfile = child.attrib.get('file')
+        if(imgfile != None and imgfile not in imgurls and not os.path.isfile(imgfile) and re.findall("^(http|https)\:\/\/", imgfile)):
+            imgurls.append(imgfile)
+    return imgurls
+
+
+def prefetch_image_urls(imgurls, maxworkers=None, deadline=None):
+    if(maxworkers == None):
+        maxworkers = prefetch_max_workers
+    if(deadline == None):
+        deadline = prefetch_deadline
+    if(len(imgurls) == 0):
+        return
+    load_urllib()
+    pending = list(imgurls)
+    pending_lock = threading.Lock()
+
+    def prefetch_worker():
+        while(True):
+            with pending_lock:
+                if(len(pending) == 0):
+                    return
+                imgurl = pending.pop(0)
+            try:
+                get_image_rgba(imgurl)
+            except Exception:
+                pass
+    workers = []
+    for i in range(min(maxworkers, len(imgurls))):
+        worker = threading.Thread(target=prefetch_worker)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    stoptime = time.time() + deadline
+    for worker in workers:
+        worker.join(max(0, stoptime - time.time()))
+
+
+def xml_stream_children(xiffile):
     if(not os.path.isfile(xiffile) and re.findall("^(http|https)\:\/\/", xiffile)):
         xmlheaders = {'User-Agent': useragent_string}
-        tree = cElementTree.ElementTree(file=urllib2.urlopen(
-            urllib2.Request(xiffile, None, xmlheaders)))
+        load_urllib()
+        xmlsource = urllib2.urlopen(urllib2.Request(xiffile, None, xmlheaders))
     if(os.path.isfile(xiffile) and not re.findall("^(http|https)\:\/\/", xiffile)):
-        tree = cElementTree.ElementTree(file=xiffile)
+        xmlsource = xiffile
     if(not os.path.isfile(xiffile) and not re.findall("^(http|https)\:\/\/", xiffile)):
-        tree = cElementTree.ElementTree(cElementTree.fromstring(text))
-    root = tree.getroot()
+        xmlsource = BytesIO(xiffile.encode("utf-8"))
+    root = None
+    depth = 0
+    for event, elem in cElementTree.iterparse(xmlsource, events=(str("start"), str("end"))):
+        if(event == "start"):
+            depth = depth + 1
+            if(root == None):
+                root = elem
+                yield root
+            continue
+        depth = depth - 1
+        if(depth == 1):
+            yield elem
+            elem.clear()
+            root.remove(elem)
+
+
+def xml_draw_image(xiffile, imgtype="png", outputimage=True, resize=1, resizetype="nearest", outfile=None, stream=False):
+    if(not str(resize).isdigit() or int(resize) < 1):
+        resize = 1
+    resize = int(resize)
+    resizetype = resizetype.lower()
+    if(resizetype != "antialias" and resizetype != "bilinear" and resizetype != "bicubic" and resizetype != "nearest"):
+        resizetype = "nearest"
+    if(stream == True):
+        xmlchildren = xml_stream_children(xiffile)
+        root = next(xmlchildren)
+    if(stream != True):
+        if(not os.path.isfile(xiffile) and re.findall("^(http|https)\:\/\/", xiffile)):
+            xmlheaders = {'User-Agent': useragent_string}
+            load_urllib()
+            tree = cElementTree.ElementTree(file=urllib2.urlopen(
+                urllib2.Request(xiffile, None, xmlheaders)))
+        if(os.path.isfile(xiffile) and not re.findall("^(http|https)\:\/\/", xiffile)):
+            tree = cElementTree.ElementTree(file=xiffile)
+        if(not os.path.isfile(xiffile) and not re.findall("^(http|https)\:\/\/", xiffile)):
+            tree = cElementTree.ElementTree(cElementTree.fromstring(xiffile))
+        root = tree.getroot()
+        prefetch_image_urls(xml_image_urls(root))
+        xmlchildren = iter(root)
     root.attrib['fill'] = colortolist(root.attrib['fill'])
     pre_xml_img = Image.new("RGB", (int(root.attrib['width']), int(
         root.attrib['height'])), color=root.attrib['fill'])
     xml_img = ImageDraw.Draw(pre_xml_img, "RGBA")
-    for child in root:
+    pointlist = array.array(str("f"))
+    pointfill = None
+    for child in xmlchildren:
+        if(len(pointlist) > 0 and child.tag != "point" and child.tag != "dot" and child.tag != "points"):
+            xml_img.point(pointlist, fill=pointfill)
+            pointlist = array.array(str("f"))
         sublist = ()
         tmp_img_paste = None
         new_img_paste = None
@@ -260,8 +605,7 @@ def xml_draw_image(xiffile, imgtype="png", outputimage=True, resize=1, resizetyp
                     colorsplit3[1], 16), int(colorsplit3[2], 16))
                 colorlist = (colorlist1, colorlist2, colorlist3)
                 xmlbarcode.update({"barcolor": colorlist})
-            tmp_img_paste = upcean.barcodes.shortcuts.validate_draw_barcode(
-                **xmlbarcode).convert('RGBA')
+            tmp_img_paste = get_barcode_image(xmlbarcode)
             pre_xml_img.paste(tmp_img_paste, sublist, tmp_img_paste)
             del(tmp_img_paste)
         if(child.tag == "bitmap"):
@@ -289,39 +633,16 @@ def xml_draw_image(xiffile, imgtype="png", outputimage=True, resize=1, resizetyp
                             coordinates.attrib['y'], int(root.attrib['height']))
                     sublist = (int(coordinates.attrib['x']), int(
                         coordinates.attrib['y']))
-            if(not os.path.isfile(child.attrib['file']) and re.findall("^(http|https)\:\/\/", child.attrib['file'])):
-                xmlheaders = {'User-Agent': useragent_string}
-                tmp_img_paste = Image.open(StringIO(urllib2.urlopen(urllib2.Request(
-                    child.attrib['file'], None, xmlheaders)).read())).convert('RGBA')
-            if(os.path.isfile(child.attrib['file']) and not re.findall("^(http|https)\:\/\/", child.attrib['file'])):
-                tmp_img_paste = Image.open(
-                    child.attrib['file']).convert('RGBA')
             if(re.findall("([0-9]+)%", child.attrib['width'])):
                 child.attrib['width'] = coordinate_calc(
                     child.attrib['width'], int(root.attrib['width']))
             if(re.findall("([0-9]+)%", child.attrib['height'])):
                 child.attrib['height'] = coordinate_calc(
                     child.attrib['height'], int(root.attrib['height']))
-            if((tmp_img_paste.size[0] < int(child.attrib['width']) or tmp_img_paste.size[0] > int(child.attrib['width'])) or (tmp_img_paste.size[1] < int(child.attrib['height']) or tmp_img_paste.size[1] > int(child.attrib['height']))):
-                if(resizetype == "antialias"):
-                    new_img_paste = tmp_img_paste.resize(
-                        (int(child.attrib['width']), int(child.attrib['height'])), Image.ANTIALIAS)
-                if(resizetype == "bilinear"):
-                    new_img_paste = tmp_img_paste.resize(
-                        (int(child.attrib['width']), int(child.attrib['height'])), Image.BILINEAR)
-                if(resizetype == "bicubic"):
-                    new_img_paste = tmp_img_paste.resize(
-                        (int(child.attrib['width']), int(child.attrib['height'])), Image.BICUBIC)
-                if(resizetype == "nearest"):
-                    new_img_paste = tmp_img_paste.resize(
-                        (int(child.attrib['width']), int(child.attrib['height'])), Image.NEAREST)
-                xml_img.bitmap(sublist, new_img_paste,
-                               fill=child.attrib['fill'])
-                del(new_img_paste)
-            if(tmp_img_paste.size[0] == int(child.attrib['width']) and tmp_img_paste.size[1] == int(child.attrib['height'])):
-                xml_img.bitmap(sublist, tmp_img_paste,
-                               fill=child.attrib['fill'])
-                del(tmp_img_paste)
+            tmp_img_paste = get_image_scaled(child.attrib['file'], int(
+                child.attrib['width']), int(child.attrib['height']), resizetype)
+            xml_img.bitmap(sublist, tmp_img_paste, fill=child.attrib['fill'])
+            del(tmp_img_paste)
         if(child.tag == "chord"):
             if('alpha' not in child.attrib):
                 child.attrib['alpha'] = 255
@@ -408,7 +729,7 @@ def xml_draw_image(xiffile, imgtype="png", outputimage=True, resize=1, resizetyp
                     sublist = (int(coordinates.attrib['x']), int(
                         coordinates.attrib['y']))
             child.attrib['fill'] = colortolistalpha(
-                child.attrib['f/usr/share/pixmaps/acidrip.pngill'], child.attrib['alpha'])
+                child.attrib['fill'], child.attrib['alpha'])
             xml_img.line(sublist, fill=child.attrib['fill'], width=int(
                 child.attrib['width']))
         if(child.tag == "multilinetext"):
@@ -442,7 +763,7 @@ def xml_draw_image(xiffile, imgtype="png", outputimage=True, resize=1, resizetyp
             if(re.findall("([0-9]+)%", child.attrib['size'])):
                 child.attrib['size'] = coordinate_calc(
                     child.attrib['size'], int(root.attrib['height']))
-            tmp_ttf_file = ImageFont.truetype(
+            tmp_ttf_file = get_ttf_font(
                 child.attrib['font'], int(child.attrib['size']))
             xml_img.multiline_text(sublist, mltextstrg, fill=child.attrib['fill'], font=tmp_ttf_file, spacing=int(
                 child.attrib['spacing']), align=child.attrib['align'])
@@ -468,37 +789,16 @@ def xml_draw_image(xiffile, imgtype="png", outputimage=True, resize=1, resizetyp
                             coordinates.attrib['y'], int(root.attrib['height']))
                     sublist = (int(coordinates.attrib['x']), int(
                         coordinates.attrib['y']))
-            if(not os.path.isfile(child.attrib['file']) and re.findall("^(http|https)\:\/\/", child.attrib['file'])):
-                xmlheaders = {'User-Agent': useragent_string}
-                tmp_img_paste = Image.open(StringIO(urllib2.urlopen(urllib2.Request(
-                    child.attrib['file'], None, xmlheaders)).read())).convert('RGBA')
-            if(os.path.isfile(child.attrib['file']) and not re.findall("^(http|https)\:\/\/", child.attrib['file'])):
-                tmp_img_paste = Image.open(
-                    child.attrib['file']).convert('RGBA')
             if(re.findall("([0-9]+)%", child.attrib['width'])):
                 child.attrib['width'] = coordinate_calc(
                     child.attrib['width'], int(root.attrib['width']))
             if(re.findall("([0-9]+)%", child.attrib['height'])):
                 child.attrib['height'] = coordinate_calc(
                     child.attrib['height'], int(root.attrib['height']))
-            if((tmp_img_paste.size[0] < int(child.attrib['width']) or tmp_img_paste.size[0] > int(child.attrib['width'])) or (tmp_img_paste.size[1] < int(child.attrib['height']) or tmp_img_paste.size[1] > int(child.attrib['height']))):
-                if(resizetype == "antialias"):
-                    new_img_paste = tmp_img_paste.resize(
-                        (int(child.attrib['width']), int(child.attrib['height'])), Image.ANTIALIAS)
-                if(resizetype == "bilinear"):
-                    new_img_paste = tmp_img_paste.resize(
-                        (int(child.attrib['width']), int(child.attrib['height'])), Image.BILINEAR)
-                if(resizetype == "bicubic"):
-                    new_img_paste = tmp_img_paste.resize(
-                        (int(child.attrib['width']), int(child.attrib['height'])), Image.BICUBIC)
-                if(resizetype == "nearest"):
-                    new_img_paste = tmp_img_paste.resize(
-                        (int(child.attrib['width']), int(child.attrib['height'])), Image.NEAREST)
-                pre_xml_img.paste(new_img_paste, sublist, new_img_paste)
-                del(new_img_paste)
-            if(tmp_img_paste.size[0] == int(child.attrib['width']) and tmp_img_paste.size[1] == int(child.attrib['height'])):
-                pre_xml_img.paste(tmp_img_paste, sublist, tmp_img_paste)
-                del(tmp_img_paste)
+            tmp_img_paste = get_image_scaled(child.attrib['file'], int(
+                child.attrib['width']), int(child.attrib['height']), resizetype)
+            pre_xml_img.paste(tmp_img_paste, sublist, tmp_img_paste)
+            del(tmp_img_paste)
         if(child.tag == "pieslice"):
             if('alpha' not in child.attrib):
                 child.attrib['alpha'] = 255
@@ -555,7 +855,29 @@ def xml_draw_image(xiffile, imgtype="png", outputimage=True, resize=1, resizetyp
                             coordinates.attrib['y'], int(root.attrib['height']))
                     sublist = (int(coordinates.attrib['x']), int(
                         coordinates.attrib['y']))
-            xml_img.point(sublist, fill=child.attrib['fill'])
+            if(len(pointlist) > 0 and pointfill != child.attrib['fill']):
+                xml_img.point(pointlist, fill=pointfill)
+                pointlist = array.array(str("f"))
+            pointlist.extend(sublist)
+            pointfill = child.attrib['fill']
+        if(child.tag == "points"):
+            if('alpha' not in child.attrib):
+                child.attrib['alpha'] = 255
+            child.attrib['fill'] = colortolistalpha(
+                child.attrib['fill'], child.attrib['alpha'])
+            if('coords' in child.attrib):
+                pointtext = child.attrib['coords']
+            else:
+                pointtext = child.text or ""
+            sublist = array.array(str("f"), [float(pointnum) for pointnum in re.split(
+                "[\s,]+", pointtext.strip()) if(pointnum != "")])
+            if(len(sublist) % 2 == 1):
+                sublist.pop()
+            if(len(pointlist) > 0 and pointfill != child.attrib['fill']):
+                xml_img.point(pointlist, fill=pointfill)
+                pointlist = array.array(str("f"))
+            pointlist.extend(sublist)
+            pointfill = child.attrib['fill']
         if(child.tag == "polygon"):
             if('alpha' not in child.attrib):
                 child.attrib['alpha'] = 255
@@ -688,11 +1010,14 @@ def xml_draw_image(xiffile, imgtype="png", outputimage=True, resize=1, resizetyp
             if(re.findall("([0-9]+)%", child.attrib['size'])):
                 child.attrib['size'] = coordinate_calc(
                     child.attrib['size'], int(root.attrib['height']))
-            tmp_ttf_file = ImageFont.truetype(
+            tmp_ttf_file = get_ttf_font(
                 child.attrib['font'], int(child.attrib['size']))
             xml_img.text(
                 sublist, child.attrib['text'], fill=child.attrib['fill'], font=tmp_ttf_file)
             del(tmp_ttf_file)
+    if(len(pointlist) > 0):
+        xml_img.point(pointlist, fill=pointfill)
+    del(pointlist)
     if(resize > 1):
         if(resizetype == "antialias"):
             new_xml_img = pre_xml_img.resize((int(root.attrib['width']) * int(
@@ -723,5 +1048,105 @@ def xml_draw_image(xiffile, imgtype="png", outputimage=True, resize=1, resizetyp
     return False
 
 
-xml_draw_image(getargs.input, getargs.outputtype, True,
-               getargs.resize, getargs.resizetype, getargs.output)
+def batch_output_name(xiffile, outdir=None, imgtype=None):
+    if(imgtype == None):
+        imgtype = "png"
+    if(re.findall("^(http|https)\:\/\/", xiffile)):
+        outname = xiffile.rstrip("/").split("/")[-1]
+    else:
+        outname = os.path.basename(xiffile)
+    outname = os.path.splitext(outname)[0]+"."+imgtype.lower()
+    if(outdir != None):
+        return os.path.join(outdir, outname)
+    if(re.findall("^(http|https)\:\/\/", xiffile)):
+        return outname
+    return os.path.join(os.path.dirname(xiffile), outname)
+
+
+def batch_list_files(batchspec, outdir=None, imgtype=None):
+    batchlist = []
+    if(batchspec == "-"):
+        batchlines = sys.stdin.readlines()
+    elif(os.path.isfile(batchspec) and not batchspec.lower().endswith((".xif", ".xml"))):
+        with open(batchspec, "r") as batchfile:
+            batchlines = batchfile.readlines()
+    else:
+        for xiffile in sorted(glob.glob(batchspec)):
+            batchlist.append(
+                (xiffile, batch_output_name(xiffile, outdir, imgtype)))
+        return batchlist
+    for batchline in batchlines:
+        batchline = batchline.strip()
+        if(batchline == "" or batchline.startswith("#")):
+            continue
+        batchsplit = batchline.split("\t", 1)
+        if(len(batchsplit) == 1 or batchsplit[1].strip() == ""):
+            batchlist.append((batchsplit[0].strip(), batch_output_name(
+                batchsplit[0].strip(), outdir, imgtype)))
+        else:
+            outfile = batchsplit[1].strip()
+            if(outdir != None and not os.path.isabs(outfile)):
+                outfile = os.path.join(outdir, outfile)
+            batchlist.append((batchsplit[0].strip(), outfile))
+    return batchlist
+
+
+def xml_draw_image_batch(batchlist, imgtype="png", resize=1, resizetype="nearest", stream=False):
+    failcount = 0
+    for xiffile, outfile in batchlist:
+        starttime = time.time()
+        try:
+            if(not re.findall("^(http|https)\:\/\/", xiffile) and not xiffile.lstrip().startswith("<") and not os.path.isfile(xiffile)):
+                raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), xiffile)
+            xml_draw_image(xiffile, imgtype, True, resize,
+                           resizetype, outfile, stream)
+            print("ok\t"+xiffile+"\t"+outfile+"\t"+"%.1fms" %
+                  ((time.time() - starttime) * 1000.0))
+        except Exception as e:
+            failcount = failcount + 1
+            print("error\t"+xiffile+"\t"+type(e).__name__+": "+str(e))
+        sys.stdout.flush()
+    sys.stderr.write(str(len(batchlist) - failcount)+" rendered, " +
+                     str(failcount)+" failed\n")
+    return failcount
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(conflict_handler="resolve", add_help=True)
+    parser.add_argument("-i", "--input", default=None,
+                        help="enter name of input file")
+    parser.add_argument("-t", "--outputtype", default=None,
+                        help="enter file type of output image")
+    parser.add_argument("-o", "--output", default=None,
+                        help="enter name of output image")
+    parser.add_argument("-s", "--resize", default=1,
+                        help="enter number to resize image")
+    parser.add_argument("-r", "--resizetype", default="nearest",
+                        help="enter resize type")
+    parser.add_argument("-b", "--batch", default=None,
+                        help="enter manifest file, glob pattern or - for stdin")
+    parser.add_argument("-d", "--outdir", default=None,
+                        help="enter output directory for batch mode")
+    parser.add_argument("--stream", action="store_true",
+                        help="draw each element as it is parsed instead of loading the whole document")
+    parser.add_argument("-v", "--version", action="version",
+                        version=__version__)
+    getargs = parser.parse_args(argv)
+    if(getargs.resizetype.lower() == "vector"):
+        sys.stderr.write(
+            "vector resize is only supported by xif2img-alt.py; using nearest\n")
+    if(getargs.batch != None):
+        if(getargs.outdir != None and not os.path.isdir(getargs.outdir)):
+            os.makedirs(getargs.outdir)
+        batchfailed = xml_draw_image_batch(batch_list_files(getargs.batch, getargs.outdir, getargs.outputtype),
+                                           getargs.outputtype, getargs.resize, getargs.resizetype, getargs.stream)
+        if(batchfailed > 0):
+            return 1
+        return 0
+    xml_draw_image(getargs.input, getargs.outputtype, True,
+                   getargs.resize, getargs.resizetype, getargs.output, getargs.stream)
+    return 0
+
+
+if(__name__ == "__main__"):
+    sys.exit(main())